@@ -0,0 +1,535 @@
+"""Banc d'essai hors ligne du bot HeroSMS
+
+Un faux serveur handler_api.php (latence et erreurs configurables) et un faux Telegram
+permettent de rejouer des sessions réalistes (recherche → srv_ → ctry_ → check_ répétés)
+avec N utilisateurs simultanés, sans réseau ni vraies clés.
+
+    python benchmark.py                          # scénarios par défaut
+    python benchmark.py --profile degraded --users 10,50
+    python benchmark.py --json bench.json --max-p99 500
+    python benchmark.py stub --port 8081         # serveur HeroSMS simulé seul
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import queue
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+import httpx
+import uvicorn
+from prometheus_client import REGISTRY
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+from telegram import Update
+from telegram.request import BaseRequest
+
+# ===== Profils =====
+
+# Latence moyenne / gigue (secondes) et taux de réponses 503 du faux HeroSMS
+PROFILES = {
+    "fast": {"latency": 0.005, "jitter": 0.002, "error_rate": 0.0},
+    "realistic": {"latency": 0.08, "jitter": 0.04, "error_rate": 0.01},
+    "degraded": {"latency": 0.4, "jitter": 0.3, "error_rate": 0.1},
+}
+
+DEFAULT_SCENARIOS = [("realistic", 10), ("realistic", 50), ("degraded", 20)]
+
+STUB_PATH = "/stubs/handler_api.php"
+
+# ===== Serveur HeroSMS simulé =====
+
+SERVICES = [
+    {"code": "tg", "name": "Telegram"},
+    {"code": "wa", "name": "WhatsApp"},
+    {"code": "go", "name": "Google,youtube,Gmail"},
+    {"code": "ds", "name": "Discord"},
+    {"code": "cb", "name": "Coinbase (crypto)"},
+] + [{"code": f"s{i}", "name": f"Service {i}"} for i in range(500)]
+
+COUNTRIES = {i: {"id": i, "eng": f"Country {i}", "rus": f"Страна {i}"} for i in range(180)}
+
+
+class StubHeroSMS:
+    """Émule les actions de handler_api.php avec un profil de latence et d'erreurs"""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, sms_delay=2.0, no_numbers_rate=0.02, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.sms_delay = sms_delay
+        self.no_numbers_rate = no_numbers_rate
+        self.rng = random.Random(seed)
+        self.reset()
+
+    def reset(self):
+        self.calls = Counter()
+        self.activations = {}
+        self.next_id = 100000
+
+    def configure(self, **settings):
+        for name, value in settings.items():
+            if value is not None:
+                setattr(self, name, value)
+
+    async def handle(self, request: Request):
+        params = request.query_params
+        action = params.get("action", "")
+        self.calls[action] += 1
+        delay = self.latency + self.rng.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.rng.random() < self.error_rate:
+            return PlainTextResponse("Service Unavailable", status_code=503)
+        handler = getattr(self, f"do_{action}", None)
+        if handler is None:
+            return PlainTextResponse("WRONG_ACTION")
+        return handler(params)
+
+    def _status(self, activation):
+        if activation["status"] == "0" and time.time() - activation["created"] >= self.sms_delay:
+            activation["status"] = "2"
+            activation["code"] = str(self.rng.randint(100000, 999999))
+        return activation
+
+    def do_getBalance(self, params):
+        return PlainTextResponse("ACCESS_BALANCE:1000.00")
+
+    def do_getServicesList(self, params):
+        return JSONResponse({"status": "success", "services": SERVICES})
+
+    def do_getCountries(self, params):
+        return JSONResponse({str(i): c for i, c in COUNTRIES.items()})
+
+    def do_getTopCountriesByService(self, params):
+        return JSONResponse({
+            str(i): {"country": i, "count": self.rng.randint(0, 5000), "price": round(0.1 + i * 0.01, 2)}
+            for i in range(40)
+        })
+
+    def do_getNumber(self, params):
+        if self.rng.random() < self.no_numbers_rate:
+            return PlainTextResponse("NO_NUMBERS")
+        self.next_id += 1
+        activation_id = str(self.next_id)
+        phone = f"7900{self.next_id:07d}"
+        self.activations[activation_id] = {
+            "activationId": activation_id,
+            "serviceCode": params.get("service"),
+            "phoneNumber": phone,
+            "status": "0",
+            "code": None,
+            "created": time.time(),
+        }
+        return PlainTextResponse(f"ACCESS_NUMBER:{activation_id}:{phone}")
+
+    def do_getStatus(self, params):
+        activation = self.activations.get(params.get("id"))
+        if activation is None:
+            return PlainTextResponse("NO_ACTIVATION")
+        activation = self._status(activation)
+        if activation["status"] == "8":
+            return PlainTextResponse("STATUS_CANCEL")
+        if activation["code"]:
+            return PlainTextResponse(f"STATUS_OK:{activation['code']}")
+        return PlainTextResponse("STATUS_WAIT_CODE")
+
+    def do_setStatus(self, params):
+        activation = self.activations.get(params.get("id"))
+        if activation is None:
+            return PlainTextResponse("NO_ACTIVATION")
+        if params.get("status") == "8":
+            activation["status"] = "8"
+            return PlainTextResponse("ACCESS_CANCEL")
+        activation["status"] = "6"
+        return PlainTextResponse("ACCESS_ACTIVATION")
+
+    def do_getActiveActivations(self, params):
+        active = []
+        for activation in self.activations.values():
+            activation = self._status(activation)
+            if activation["status"] in ("0", "2"):
+                active.append({
+                    "activationId": activation["activationId"],
+                    "serviceCode": activation["serviceCode"],
+                    "phoneNumber": activation["phoneNumber"],
+                    "activationStatus": activation["status"],
+                    "smsCode": activation["code"],
+                })
+        return JSONResponse({"status": "success", "activeActivations": active})
+
+    def do_getHistory(self, params):
+        return JSONResponse([])
+
+    def app(self):
+        async def stats(request: Request):
+            return JSONResponse(dict(self.calls))
+
+        async def reset(request: Request):
+            self.reset()
+            body = await request.body()
+            if body:
+                self.configure(**json.loads(body))
+            return Response(status_code=204)
+
+        return Starlette(routes=[
+            Route(STUB_PATH, self.handle),
+            Route("/_stats", stats),
+            Route("/_reset", reset, methods=["POST"]),
+        ])
+
+
+def run_stub(port, profile="realistic", sms_delay=2.0):
+    stub = StubHeroSMS(sms_delay=sms_delay, **PROFILES[profile])
+    uvicorn.run(stub.app(), host="127.0.0.1", port=port, log_level="warning")
+
+# ===== Faux Telegram =====
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "HeroSMS Bench", "username": "hero_bench_bot"}
+
+
+class FakeTelegram(BaseRequest):
+    """Répond localement aux appels de l'API Bot et garde le dernier message de chaque chat"""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.messages = {}
+        self.next_message_id = 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def last_message(self, chat_id):
+        return self.messages.get(chat_id)
+
+    def buttons(self, chat_id):
+        """callback_data des boutons du dernier message du chat"""
+        message = self.messages.get(chat_id) or {}
+        keyboard = (message.get("reply_markup") or {}).get("inline_keyboard", [])
+        return [button.get("callback_data", "") for row in keyboard for button in row]
+
+    def _message(self, chat_id, message_id, params):
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+        if params.get("reply_markup"):
+            message["reply_markup"] = params["reply_markup"]
+        self.messages[chat_id] = message
+        return message
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] += 1
+
+        if endpoint == "getMe":
+            result = BOT_USER
+        elif endpoint == "sendMessage":
+            result = self._message(params["chat_id"], self.next_message_id, params)
+            self.next_message_id += 1
+        elif endpoint == "editMessageText":
+            result = self._message(params["chat_id"], params["message_id"], params)
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class UpdateFactory:
+    """Fabrique des updates Telegram (dict) comme ceux reçus par le webhook"""
+
+    def __init__(self):
+        self.next_update_id = 1
+
+    def _update(self, **payload):
+        update = {"update_id": self.next_update_id, **payload}
+        self.next_update_id += 1
+        return update
+
+    @staticmethod
+    def user(user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}
+
+    def message(self, user_id, text):
+        return self._update(message={
+            "message_id": self.next_update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self.user(user_id),
+            "text": text,
+        })
+
+    def callback(self, user_id, message, data):
+        return self._update(callback_query={
+            "id": str(self.next_update_id),
+            "from": self.user(user_id),
+            "chat_instance": str(user_id),
+            "message": message,
+            "data": data,
+        })
+
+# ===== Sessions =====
+
+SEARCH_TERMS = ["telegram", "whatsapp", "google", "discord", "crypto"]
+
+
+def first_button(buttons, prefix):
+    return next((b for b in buttons if b.startswith(prefix)), None)
+
+
+async def run_session(bot, application, telegram, factory, user_id, checks, think, samples, quick=False):
+    """Une session : recherche → service → pays (ou ⚡ en un clic) → vérifications ; False si interrompue"""
+    async def step(name, data):
+        started = time.perf_counter()
+        update = Update.de_json(data, bot)
+        # Même chemin que les updates réels : ordonnanceur puis handlers
+        await application.update_processor.process_update(update, application.process_update(update))
+        samples[name].append(time.perf_counter() - started)
+
+    await step("search", factory.message(user_id, random.choice(SEARCH_TERMS)))
+    steps = (("srv_", "srv"), ("ctry_", "ctry"))
+    if quick and first_button(telegram.buttons(user_id), "quick_"):
+        steps = (("quick_", "quick"),)
+    for prefix, name in steps:
+        data = first_button(telegram.buttons(user_id), prefix)
+        if data is None:
+            return False
+        await step(name, factory.callback(user_id, telegram.last_message(user_id), data))
+
+    for _ in range(checks):
+        data = first_button(telegram.buttons(user_id), "check_")
+        if data is None:
+            # Code déjà livré par la surveillance
+            break
+        await asyncio.sleep(think)
+        await step("check", factory.callback(user_id, telegram.last_message(user_id), data))
+    return True
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+async def run_scenario(profile, users, checks, think, keep_limits, quick):
+    """Rejoue `users` sessions simultanées contre le bot (importé dans ce processus)"""
+    import hero_telegram_bot as bot_module
+
+    outbound = None
+    if not keep_limits:
+        # On mesure le bot, pas les quotas locaux (HeroSMS et anti-flood Telegram)
+        for account in bot_module.key_pool.accounts:
+            account.client.limiter.buckets.clear()
+            account.client.limiter.global_bucket = bot_module.TokenBucket(1e9)
+        outbound = bot_module.OutboundLimiter(
+            bot_module.state_backend, global_rate=1e9, chat_rate=1e9, chat_burst=1e9
+        )
+
+    telegram = FakeTelegram()
+    factory = UpdateFactory()
+    application = bot_module.build_application(updater=False, request=telegram, rate_limiter=outbound)
+    samples = defaultdict(list)
+
+    async with application:
+        await bot_module.start_services(application)
+        if quick:
+            # Index des prix déjà chaud, comme en production
+            await bot_module.price_index.refresh()
+        started = time.perf_counter()
+        completed = await asyncio.gather(*(
+            run_session(application.bot, application, telegram, factory, 10_000 + i, checks, think, samples, quick)
+            for i in range(users)
+        ))
+        elapsed = time.perf_counter() - started
+        await bot_module.close_clients(application)
+
+    steps = sum(len(v) for v in samples.values())
+    return {
+        "profile": profile + (" (quick)" if quick else ""),
+        "users": users,
+        "elapsed": elapsed,
+        "incomplete": completed.count(False),
+        "steps": steps,
+        "throughput": steps / elapsed if elapsed else 0.0,
+        "latency": {
+            name: {
+                "n": len(values),
+                "p50": percentile(values, 50) * 1000,
+                "p99": percentile(values, 99) * 1000,
+            }
+            for name, values in sorted(samples.items())
+        },
+        "telegram_calls": dict(telegram.calls),
+        "coalesced": sum(
+            REGISTRY.get_sample_value("telegram_outbound_total", {"endpoint": e, "result": "coalesced"}) or 0
+            for e in bot_module.COALESCED_ENDPOINTS
+        ),
+    }
+
+
+def scenario_process(stub_url, profile, users, checks, think, keep_limits, quick, results):
+    """Chaque scénario tourne dans un processus neuf : caches froids, rien de partagé"""
+    workdir = tempfile.mkdtemp(prefix="hero-bench-")
+    os.environ.update({
+        "HERO_BASE_URL": stub_url,
+        "BOT_TOKEN": "123456:bench",
+        "API_KEY": "bench",
+        "API_KEYS": "bench",
+        "USE_POLLING": "1",
+        "STATE_BACKEND": "memory",
+        "STORE_PATH": os.path.join(workdir, "bench.sqlite3"),
+        "SNAPSHOT_DIR": workdir,
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    # Les traces du bot ne polluent pas le rapport
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = asyncio.run(run_scenario(profile, users, checks, think, keep_limits, quick))
+    results.put(result)
+
+# ===== Rapport =====
+
+def print_report(result):
+    print(f"\n== {result['profile']} / {result['users']} utilisateurs ==")
+    print(
+        f"{result['steps']} étapes en {result['elapsed']:.2f} s → {result['throughput']:.1f} étapes/s"
+        f" (sessions incomplètes : {result['incomplete']})"
+    )
+    print(f"{'étape':<8}{'n':>6}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, stats in result["latency"].items():
+        print(f"{name:<8}{stats['n']:>6}{stats['p50']:>10.1f}{stats['p99']:>10.1f}")
+    upstream = ", ".join(f"{k}={v}" for k, v in sorted(result["upstream_calls"].items()))
+    print(f"HeroSMS ({sum(result['upstream_calls'].values())} appels) : {upstream}")
+    telegram = ", ".join(f"{k}={v}" for k, v in sorted(result["telegram_calls"].items()))
+    print(f"Telegram : {telegram} (éditions fusionnées : {result['coalesced']:.0f})")
+
+
+def stub_request(client, method, path, **kwargs):
+    """Appel au serveur simulé, en attendant qu'il ait fini de démarrer"""
+    for _ in range(100):
+        try:
+            return client.request(method, path, **kwargs)
+        except httpx.TransportError:
+            time.sleep(0.1)
+    raise RuntimeError("le serveur HeroSMS simulé ne répond pas")
+
+
+def wait_result(process, results, timeout):
+    """Résultat d'un scénario, ou None si son processus meurt ou dépasse `timeout` secondes"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            if not process.is_alive():
+                # Dernière chance : le résultat a pu être posté juste avant la sortie
+                try:
+                    return results.get(timeout=1)
+                except queue.Empty:
+                    return None
+    return None
+
+
+def run_benchmarks(args):
+    context = multiprocessing.get_context("spawn")
+    stub = context.Process(target=run_stub, args=(args.port, "fast", args.sms_delay), daemon=True)
+    stub.start()
+    base = f"http://127.0.0.1:{args.port}"
+    stub_url = base + STUB_PATH
+
+    if args.profile:
+        scenarios = [(args.profile, int(u)) for u in args.users.split(",")]
+    else:
+        scenarios = DEFAULT_SCENARIOS
+
+    report = []
+    failed = []
+    try:
+        with httpx.Client(base_url=base) as client:
+            for profile, users in scenarios:
+                settings = dict(PROFILES[profile], sms_delay=args.sms_delay)
+                stub_request(client, "POST", "/_reset", content=json.dumps(settings))
+
+                results = context.Queue()
+                process = context.Process(
+                    target=scenario_process,
+                    args=(stub_url, profile, users, args.checks, args.think, args.keep_limits, args.quick, results),
+                )
+                process.start()
+                result = wait_result(process, results, args.timeout)
+                if result is None:
+                    process.terminate()
+                    process.join()
+                    reason = f"code de sortie {process.exitcode}"
+                    print(f"\n❌ {profile}/{users} : scénario interrompu ({reason})")
+                    failed.append(f"{profile}/{users}")
+                    continue
+                process.join()
+
+                result["upstream_calls"] = client.get("/_stats").json()
+                print_report(result)
+                report.append(result)
+    finally:
+        stub.terminate()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if failed:
+        return 1
+    if args.max_p99 is not None:
+        slow = [
+            f"{r['profile']}/{r['users']} {name} p99={stats['p99']:.0f} ms"
+            for r in report for name, stats in r["latency"].items()
+            if stats["p99"] > args.max_p99
+        ]
+        if slow:
+            print("\n❌ p99 au-dessus du seuil : " + "; ".join(slow))
+            return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Banc d'essai hors ligne du bot HeroSMS")
+    parser.add_argument("mode", nargs="?", choices=["bench", "stub"], default="bench")
+    parser.add_argument("--port", type=int, default=8765, help="port du serveur HeroSMS simulé")
+    parser.add_argument("--profile", choices=sorted(PROFILES), help="profil HeroSMS (défaut : scénarios prédéfinis)")
+    parser.add_argument("--users", default="10,50", help="utilisateurs simultanés, ex. 10,50,100")
+    parser.add_argument("--checks", type=int, default=3, help="clics check_ par session")
+    parser.add_argument("--think", type=float, default=2.0, help="pause entre deux check_ (s)")
+    parser.add_argument("--sms-delay", type=float, default=5.0, help="délai avant réception du SMS (s)")
+    parser.add_argument("--quick", action="store_true", help="commander via les boutons ⚡ quand ils sont proposés")
+    parser.add_argument("--keep-limits", action="store_true", help="garder le limiteur de débit du bot")
+    parser.add_argument("--json", help="écrit les résultats dans ce fichier")
+    parser.add_argument("--max-p99", type=float, help="échec si une étape dépasse ce p99 (ms)")
+    parser.add_argument("--timeout", type=float, default=600, help="durée maximale d'un scénario (s)")
+    args = parser.parse_args()
+
+    if args.mode == "stub":
+        print(f"🧪 HeroSMS simulé sur http://127.0.0.1:{args.port}{STUB_PATH} ({args.profile or 'realistic'})")
+        run_stub(args.port, args.profile or "realistic", args.sms_delay)
+        return 0
+    return run_benchmarks(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,246 +1,2260 @@
+import time
+
+# Profil de démarrage : durée du chargement du module (imports compris)
+IMPORT_STARTED = time.perf_counter()
+
 import os
-import requests
+import sys
+import random
+import asyncio
+import atexit
+import bisect
+import contextlib
+import contextvars
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+import secrets
+import socket
+import sqlite3
+import httpx
+from collections import defaultdict, namedtuple
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
-from threading import Thread
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from telegram.error import RetryAfter, TelegramError
+from telegram.ext import (
+    Application, BaseRateLimiter, BaseUpdateProcessor, CallbackQueryHandler, CommandHandler, ContextTypes,
+    MessageHandler, TypeHandler, filters
+)
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
 
 load_dotenv()
 
+def parse_action_map(value):
+    """Parse "getBalance=3,getNumber=20" en {"getBalance": 3.0, "getNumber": 20.0}"""
+    result = {}
+    for item in filter(None, value.split(",")):
+        action, _, number = item.partition("=")
+        result[action.strip()] = float(number)
+    return result
+
 API_KEY = os.getenv("API_KEY")
+# Plusieurs comptes HeroSMS : API_KEYS="cle1,cle2" (API_KEY seul sinon)
+API_KEYS = [k.strip() for k in os.getenv("API_KEYS", "").split(",") if k.strip()] or [API_KEY]
+# Soldes : réconciliation périodique avec getBalance, et âge maximal d'un solde affiché
+BALANCE_REFRESH_INTERVAL = float(os.getenv("BALANCE_REFRESH_INTERVAL", 20))
+BALANCE_TTL = float(os.getenv("BALANCE_TTL", 30))
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-BASE_URL = "https://hero-sms.com/stubs/handler_api.php"
+BASE_URL = os.getenv("HERO_BASE_URL", "https://hero-sms.com/stubs/handler_api.php")
+
+# Mode webhook : Telegram pousse les updates sur notre serveur (Render fournit RENDER_EXTERNAL_URL)
+PORT = int(os.getenv("PORT", 10000))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") or os.getenv("RENDER_EXTERNAL_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_hex(16)
+USE_POLLING = os.getenv("USE_POLLING", "").lower() in ("1", "true", "yes") or not WEBHOOK_URL
+
+# Plusieurs workers : ROLE=all (un processus, ou WORKERS>1 lancés localement), ingress ou worker
+ROLE = os.getenv("ROLE", "all")
+WORKERS = int(os.getenv("WORKERS", 1))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", 0))
+WORKER_PORT = int(os.getenv("WORKER_PORT", 0))
+# État partagé (caches, quotas, surveillance) : memory (un processus) ou redis
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+# Pool de connexions HTTP partagé (keep-alive vers hero-sms.com)
+HERO_MAX_CONNECTIONS = int(os.getenv("HERO_MAX_CONNECTIONS", 20))
+HERO_MAX_KEEPALIVE = int(os.getenv("HERO_MAX_KEEPALIVE", HERO_MAX_CONNECTIONS))
+HERO_KEEPALIVE_EXPIRY = float(os.getenv("HERO_KEEPALIVE_EXPIRY", 60))
+
+# Timeouts par action (en secondes), surchargeables via HERO_TIMEOUTS="getBalance=3,getNumber=20"
+DEFAULT_TIMEOUT = 10
+ACTION_TIMEOUTS = {
+    "getBalance": 4,
+    "getServicesList": 15,
+    "getTopCountriesByService": 8,
+    "getCountries": 15,
+    "getNumber": 20,
+    "getStatus": 5,
+    "setStatus": 10,
+    "getActiveActivations": 8,
+    "getHistory": 10,
+}
+ACTION_TIMEOUTS.update(parse_action_map(os.getenv("HERO_TIMEOUTS", "")))
+
+# Retries bornés (avec jitter) uniquement pour les lectures idempotentes
+HERO_MAX_RETRIES = int(os.getenv("HERO_MAX_RETRIES", 2))
+HERO_RETRY_BASE_DELAY = float(os.getenv("HERO_RETRY_BASE_DELAY", 0.25))
+IDEMPOTENT_ACTIONS = {
+    "getBalance",
+    "getServicesList",
+    "getTopCountriesByService",
+    "getCountries",
+    "getStatus",
+    "getActiveActivations",
+    "getHistory",
+}
+
+# Limiteur de débit (jetons/seconde) de chaque compte, global et par action (HERO_ACTION_RATES)
+HERO_RATE = float(os.getenv("HERO_RATE", 20))
+HERO_BURST = float(os.getenv("HERO_BURST", 2 * HERO_RATE))
+HERO_RATE_MAX_WAIT = float(os.getenv("HERO_RATE_MAX_WAIT", 5))
+ACTION_RATES = {
+    "getBalance": 2,
+    "getServicesList": 1,
+    "getTopCountriesByService": 5,
+    "getCountries": 1,
+    "getNumber": 5,
+    "getStatus": 10,
+    "setStatus": 5,
+    "getActiveActivations": 2,
+    "getHistory": 2,
+}
+ACTION_RATES.update(parse_action_map(os.getenv("HERO_ACTION_RATES", "")))
+
+# Disjoncteur : s'ouvre après N échecs consécutifs (timeouts / 5xx)
+HERO_BREAKER_THRESHOLD = int(os.getenv("HERO_BREAKER_THRESHOLD", 5))
+HERO_BREAKER_COOLDOWN = float(os.getenv("HERO_BREAKER_COOLDOWN", 30))
+
+# Catalogue des services : change quelques fois par jour
+SERVICES_TTL = float(os.getenv("SERVICES_TTL", 3600))
+
+# Annuaire des pays : quasi statique, rafraîchi périodiquement
+COUNTRIES_REFRESH_INTERVAL = float(os.getenv("COUNTRIES_REFRESH_INTERVAL", 6 * 3600))
+
+# Top pays par service : TTL court, la disponibilité bouge vite
+TOP_COUNTRIES_TTL = float(os.getenv("TOP_COUNTRIES_TTL", 30))
+TOP_COUNTRIES_LIMIT = 15
+
+# Index prix / stock des services populaires, pour la commande en un clic
+POPULAR_SERVICES = [s.strip() for s in os.getenv("POPULAR_SERVICES", "tg,wa,go,ig,fb,ds").split(",") if s.strip()]
+PRICE_INDEX_INTERVAL = float(os.getenv("PRICE_INDEX_INTERVAL", TOP_COUNTRIES_TTL))
+QUICK_MIN_STOCK = int(os.getenv("QUICK_MIN_STOCK", 20))
+QUICK_MAX_PRICE = float(os.getenv("QUICK_MAX_PRICE", 1.0))
+
+# Surveillance des activations : intervalle adaptatif entre deux getActiveActivations
+WATCH_MIN_INTERVAL = float(os.getenv("WATCH_MIN_INTERVAL", 3))
+WATCH_MAX_INTERVAL = float(os.getenv("WATCH_MAX_INTERVAL", 30))
+WATCH_BACKOFF = 1.5
+ACTIVATION_LIFETIME = float(os.getenv("ACTIVATION_LIFETIME", 20 * 60))
+# Plusieurs workers : bail d'une activation, renouvelé à chaque passage du worker qui la surveille
+WATCH_LEASE_TTL = 3 * WATCH_MAX_INTERVAL
+
+# Pagination des vues activations / historique
+ACTIVATIONS_PAGE_SIZE = 5
+HISTORY_PAGE_SIZE = 10
+RECENT_HISTORY_SIZE = 5
+HISTORY_DAYS = int(os.getenv("HISTORY_DAYS", 7))
+ACTIVE_SNAPSHOT_TTL = float(os.getenv("ACTIVE_SNAPSHOT_TTL", 15))
+
+# Commande groupée /bulk
+BULK_MAX = int(os.getenv("BULK_MAX", 100))
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", 5))
+BULK_PROGRESS_INTERVAL = 1.5
+
+# Ordonnancement : updates traités en parallèle (plafond global), un seul à la fois par chat
+SCHED_MAX_RUNNING = int(os.getenv("SCHED_MAX_RUNNING", 32))
+SCHED_CHAT_QUEUE = int(os.getenv("SCHED_CHAT_QUEUE", 3))
+SCHED_MAX_PENDING = 4096
+
+# Envois Telegram : ~30 messages/s au total et ~1/s par chat (rafales courtes tolérées)
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", 25))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", 1))
+TG_CHAT_BURST = float(os.getenv("TG_CHAT_BURST", 5))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", 2))
+TG_CHAT_BUCKETS_MAX = 10000
+PACED_ENDPOINTS = {
+    "sendMessage", "editMessageText", "editMessageReplyMarkup", "editMessageCaption", "sendPhoto", "sendDocument",
+}
+COALESCED_ENDPOINTS = {"editMessageText", "editMessageReplyMarkup", "editMessageCaption"}
+
+# Persistance des activations (SQLite en mode WAL)
+STORE_PATH = os.getenv("STORE_PATH", "data/hero_bot.sqlite3")
+STORE_FLUSH_INTERVAL = float(os.getenv("STORE_FLUSH_INTERVAL", 0.5))
+
+# Instantanés disque pour servir les menus dès le démarrage
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", ".cache")
+# Attente maximale du préchauffage (sans instantané disque) avant de se déclarer prêt
+STARTUP_WARMUP_TIMEOUT = float(os.getenv("STARTUP_WARMUP_TIMEOUT", 10))
+
+# Logs JSON (LOG_FORMAT=text en local) ; LOG_SAMPLE_RATES="trace=0.2,hero_call=0.1"
+# trace : part des updates (identifiants de corrélation) gardés en entier, logs échantillonnés compris ;
+# les autres taux s'appliquent aux événements hors corrélation (tâches de fond, accès HTTP)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_SAMPLE_RATES = {"trace": 0.2, "hero_call": 0.1, "update": 0.2, "uvicorn.access": 0.1}
+LOG_SAMPLE_RATES.update(parse_action_map(os.getenv("LOG_SAMPLE_RATES", "")))
+
+# ===== Journalisation =====
+
+# Identifiant de corrélation : l'update Telegram (ou la tâche de fond) en cours
+correlation_id = contextvars.ContextVar("correlation_id", default=None)
+
+log = logging.getLogger("herobot")
+
+def fields(**values):
+    """Champs structurés d'une ligne de log : log.info("...", extra=fields(event="x", ...))"""
+    return {"fields": values}
+
+class ContextFilter(logging.Filter):
+    """Attache l'identifiant de corrélation dans le contexte de l'appelant (avant la file)"""
+
+    def filter(self, record):
+        record.correlation_id = correlation_id.get()
+        return True
+
+class SamplingFilter(logging.Filter):
+    """Échantillonne les événements à fort volume ; WARNING et au-delà passent toujours
+
+    Un même identifiant de corrélation donne toujours la même décision : un update est
+    journalisé en entier (update, appels HeroSMS…) ou pas du tout.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.trace_rate = rates.get("trace", 1.0)
+
+    @staticmethod
+    def _fraction(key):
+        """Valeur stable dans [0, 1) pour une clé"""
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big") / 2 ** 64
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        event = getattr(record, "fields", {}).get("event") or record.name
+        rate = self.rates.get(event, 1.0)
+        if rate >= 1.0:
+            return True
+        trace = getattr(record, "correlation_id", None)
+        if trace:
+            return self._fraction(trace) < self.trace_rate
+        return random.random() < rate
+
+class JsonFormatter(logging.Formatter):
+    """Une ligne JSON par enregistrement"""
+
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "correlation_id", None):
+            entry["correlation_id"] = record.correlation_id
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Dépose l'enregistrement dans la file ; le formatage JSON se fait dans le thread d'écriture"""
+
+    def prepare(self, record):
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+log_listener = None
+
+def setup_logging(level=LOG_LEVEL, fmt=LOG_FORMAT, sample_rates=LOG_SAMPLE_RATES):
+    """Logs non bloquants : la boucle ne fait que déposer dans une file, un thread écrit sur stdout"""
+    global log_listener
+    if log_listener is not None:
+        return
+    output = logging.StreamHandler(sys.stdout)
+    if fmt == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(correlation_id)s] %(message)s"))
+
+    handler = LogQueueHandler(queue.SimpleQueue())
+    handler.addFilter(ContextFilter())
+    handler.addFilter(SamplingFilter(sample_rates))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    # httpx journalise chaque URL, clé API comprise
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("httpcore").setLevel(logging.WARNING)
+
+    log_listener = logging.handlers.QueueListener(handler.queue, output)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+# ===== Métriques =====
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20)
+
+HERO_LATENCY = Histogram(
+    "hero_request_duration_seconds", "Latence des appels HeroSMS", ["action"], buckets=LATENCY_BUCKETS
+)
+HERO_IN_FLIGHT = Gauge("hero_requests_in_flight", "Appels HeroSMS en cours", ["action"])
+HERO_RESPONSES = Counter("hero_responses_total", "Réponses HeroSMS par statut", ["action", "status"])
+HERO_ERRORS = Counter("hero_errors_total", "Erreurs réseau HeroSMS", ["action", "error"])
+HERO_RETRIES = Counter("hero_retries_total", "Nouvelles tentatives HeroSMS", ["action"])
+HERO_REJECTED = Counter("hero_rejected_total", "Appels HeroSMS refusés localement", ["action", "reason"])
+HERO_THROTTLED = Counter("hero_throttled_total", "Appels HeroSMS retardés par le limiteur", ["action"])
+CIRCUIT_STATE = Gauge(
+    "hero_circuit_state", "État du disjoncteur HeroSMS par compte (0 fermé, 1 ouvert, 2 semi-ouvert)", ["account"]
+)
+CIRCUIT_TRIPS = Counter("hero_circuit_trips_total", "Ouvertures du disjoncteur HeroSMS", ["account"])
+ACCOUNT_BALANCE = Gauge("hero_account_balance", "Solde connu par compte HeroSMS", ["account"])
+ACCOUNT_IN_FLIGHT = Gauge("hero_account_orders_in_flight", "Commandes en cours par compte HeroSMS", ["account"])
+CACHE_REQUESTS = Counter("cache_requests_total", "Accès aux caches", ["cache", "result"])
+HANDLER_LATENCY = Histogram(
+    "bot_handler_duration_seconds", "Durée de traitement par route", ["route"], buckets=LATENCY_BUCKETS
+)
+HANDLER_IN_FLIGHT = Gauge("bot_handlers_in_flight", "Updates Telegram en cours de traitement")
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Exceptions par route", ["route"])
+WATCHED_ACTIVATIONS = Gauge("activations_watched", "Activations en attente de SMS surveillées")
+SCHED_QUEUED = Gauge("bot_updates_queued", "Updates en attente de leur tour dans la file de leur chat")
+TELEGRAM_OUTBOUND = Counter(
+    "telegram_outbound_total", "Appels sortants vers l'API Bot", ["endpoint", "result"]
+)
+STARTUP_SECONDS = Gauge("bot_startup_seconds", "Durée des étapes du démarrage", ["step"])
+SCHED_SHED = Counter("bot_updates_shed_total", "Updates délestés par l'ordonnanceur", ["reason"])
+
+def response_status(response):
+    """Statut HeroSMS d'une réponse (ACCESS_NUMBER, NO_BALANCE, STATUS_WAIT_CODE, JSON...)"""
+    if response.status_code != 200:
+        return f"HTTP_{response.status_code}"
+    try:
+        head = response.content[:48].decode("utf-8", "replace").strip()
+    except httpx.ResponseNotRead:
+        # Corps lu au fil de l'eau par l'appelant
+        return "STREAM"
+    if head[:1] in ("{", "["):
+        return "JSON"
+    token = head.split(":", 1)[0]
+    if token and token.replace("_", "").isalnum() and token.isupper():
+        return token
+    return "OTHER"
+
+def instrumented(route_of):
+    """Mesure durée, erreurs et updates en cours d'un handler"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            route = route_of(update)
+            with HANDLER_IN_FLIGHT.track_inprogress(), HANDLER_LATENCY.labels(route).time():
+                try:
+                    return await handler(update, context)
+                except Exception:
+                    HANDLER_ERRORS.labels(route).inc()
+                    raise
+        return wrapper
+    return decorator
 
 # ===== Serveur HTTP pour Render =====
 
-class SimpleHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html')
-        self.end_headers()
-        self.wfile.write(b'<h1>HeroSMS Bot is running!</h1>')
-    
-    def log_message(self, format, *args):
-        return  # Silence les logs
-
-def start_http_server():
-    port = int(os.getenv('PORT', 10000))
-    server = HTTPServer(('0.0.0.0', port), SimpleHandler)
-    print(f"🌐 HTTP Server started on port {port}")
-    server.serve_forever()
-
-# ===== Fonctions HeroSMS =====
-
-def get_balance():
-    """Récupère le solde"""
-    params = {"action": "getBalance", "api_key": API_KEY}
-    response = requests.get(BASE_URL, params=params, timeout=10)
-    return response.text.replace("ACCESS_BALANCE:", "")
-
-def get_all_services(lang="en"):
-    """Récupère TOUS les services disponibles"""
-    params = {
-        "action": "getServicesList",
-        "lang": lang,
-        "api_key": API_KEY
-    }
-    response = requests.get(BASE_URL, params=params, timeout=10)
-    data = response.json()
-    
-    if data.get("status") == "success":
-        return data.get("services", [])
-    return []
-
-def get_countries_for_service(service_code):
-    """Récupère les pays disponibles pour un service"""
-    params = {
-        "action": "getTopCountriesByService",
-        "service": service_code,
-        "api_key": API_KEY
-    }
-    
+class BotState:
+    """État du processus exposé par les routes de santé
+
+    /healthz (vivant) répond dès que le serveur écoute ; /readyz (prêt) attend que le bot
+    soit démarré et ses caches préchauffés (instantanés disque ou HeroSMS).
+    """
+
+    def __init__(self):
+        self.ready = False
+        self.warm = asyncio.Event()
+        self.profile = {}
+
+    def record(self, step, seconds):
+        """Ajoute une étape au profil de démarrage"""
+        self.profile[step] = round(seconds, 3)
+        STARTUP_SECONDS.labels(step).set(seconds)
+
+bot_state = BotState()
+
+def create_web_app(application, dispatch=None, webhook=not USE_POLLING):
+    """Application ASGI : webhook Telegram + routes de santé
+
+    dispatch reçoit l'update brut (dict) ; par défaut il part dans la file de l'application.
+    """
+    from starlette.applications import Starlette
+    from starlette.requests import Request
+    from starlette.responses import HTMLResponse, PlainTextResponse, Response
+    from starlette.routing import Route
+
+    async def enqueue(data):
+        await application.update_queue.put(Update.de_json(data, application.bot))
+
+    dispatch = dispatch or enqueue
+
+    async def home(request: Request):
+        return HTMLResponse("<h1>HeroSMS Bot is running!</h1>")
+
+    async def healthz(request: Request):
+        return PlainTextResponse("ok")
+
+    async def metrics(request: Request):
+        return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+    async def readyz(request: Request):
+        if bot_state.ready:
+            return PlainTextResponse("ready")
+        return PlainTextResponse("starting", status_code=503)
+
+    async def telegram_webhook(request: Request):
+        if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return Response(status_code=403)
+        await dispatch(await request.json())
+        return Response(status_code=200)
+
+    routes = [
+        Route("/", home),
+        Route("/healthz", healthz),
+        Route("/readyz", readyz),
+        Route("/metrics", metrics),
+    ]
+    if webhook:
+        routes.append(Route(WEBHOOK_PATH, telegram_webhook, methods=["POST"]))
+    return Starlette(routes=routes)
+
+def create_server(app, port):
+    """Serveur uvicorn (importé seulement par les processus qui exposent HTTP)"""
+    import uvicorn
+    return uvicorn.Server(uvicorn.Config(app, host="0.0.0.0", port=port, log_level="info", log_config=None))
+
+# ===== État partagé =====
+
+class TokenBucket:
+    """Seau à jetons asynchrone (débit en jetons/seconde, rafale = capacité)
+
+    Le jeton est réservé dès l'appel (le solde peut devenir négatif) : chaque appelant
+    connaît aussitôt son attente réelle, files d'attente comprises, et dort sans verrou.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, max_wait=None):
+        """Prend un jeton ; False si l'attente dépasserait max_wait secondes"""
+        self._refill()
+        wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0
+        if max_wait is not None and wait > max_wait:
+            return False
+        self.tokens -= 1
+        if wait:
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                # Jeton réservé mais jamais utilisé : rendu aux suivants
+                self.tokens += 1
+                raise
+        return True
+
+class MemoryBackend:
+    """État partagé en mémoire : un seul processus"""
+
+    shared = False
+
+    def __init__(self):
+        self._values = {}
+        self._hashes = defaultdict(dict)
+        self._queues = defaultdict(asyncio.Queue)
+
+    def _alive(self, key):
+        entry = self._values.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._values[key]
+            return None
+        return entry
+
+    async def get_json(self, key):
+        entry = self._alive(key)
+        return entry[0] if entry else None
+
+    async def set_json(self, key, value, ttl=None):
+        self._values[key] = (value, time.monotonic() + ttl if ttl else None)
+
+    def bucket(self, key, rate, capacity=None):
+        return TokenBucket(rate, capacity)
+
+    async def acquire_lease(self, key, owner, ttl):
+        """Prend (ou renouvelle) un bail exclusif ; False s'il appartient à un autre"""
+        entry = self._alive(key)
+        if entry and entry[0] != owner:
+            return False
+        await self.set_json(key, owner, ttl)
+        return True
+
+    async def release_lease(self, key, owner):
+        entry = self._alive(key)
+        if entry and entry[0] == owner:
+            del self._values[key]
+
+    async def hset_json(self, name, field, value):
+        self._hashes[name][field] = value
+
+    async def hdel(self, name, field):
+        self._hashes[name].pop(field, None)
+
+    async def hgetall_json(self, name):
+        return dict(self._hashes[name])
+
+    async def push(self, queue, value):
+        await self._queues[queue].put(value)
+
+    async def pop(self, queue, timeout):
+        try:
+            return await asyncio.wait_for(self._queues[queue].get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def close(self):
+        pass
+
+# Seau à jetons atomique côté Redis ; renvoie l'attente nécessaire (0 = jeton pris)
+REDIS_BUCKET_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) + tonumber(now_parts[2]) / 1000000
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + (now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+REDIS_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return 1
+end
+return 0
+"""
+
+REDIS_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+class RedisTokenBucket:
+    """Seau à jetons partagé entre processus via Redis"""
+
+    def __init__(self, script, key, rate, capacity=None):
+        self.script = script
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+
+    async def acquire(self, max_wait=None):
+        started = time.monotonic()
+        while True:
+            wait = float(await self.script(keys=[self.key], args=[self.rate, self.capacity]))
+            if wait <= 0:
+                return True
+            if max_wait is not None and time.monotonic() - started + wait > max_wait:
+                return False
+            await asyncio.sleep(wait)
+
+class RedisBackend:
+    """État partagé dans Redis (ou tout serveur compatible) : plusieurs processus ou machines"""
+
+    shared = True
+
+    def __init__(self, url=REDIS_URL, prefix="herobot:"):
+        try:
+            # Importé seulement si ce backend est choisi
+            import redis.asyncio as redis_asyncio
+        except ImportError:
+            raise RuntimeError("STATE_BACKEND=redis nécessite le paquet `redis` (pip install redis)") from None
+        self.redis = redis_asyncio.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self._bucket_script = self.redis.register_script(REDIS_BUCKET_SCRIPT)
+        self._lease_script = self.redis.register_script(REDIS_LEASE_SCRIPT)
+        self._release_script = self.redis.register_script(REDIS_RELEASE_SCRIPT)
+
+    async def get_json(self, key):
+        raw = await self.redis.get(self.prefix + key)
+        return None if raw is None else json.loads(raw)
+
+    async def set_json(self, key, value, ttl=None):
+        await self.redis.set(self.prefix + key, json.dumps(value), px=int(ttl * 1000) if ttl else None)
+
+    def bucket(self, key, rate, capacity=None):
+        return RedisTokenBucket(self._bucket_script, self.prefix + key, rate, capacity)
+
+    async def acquire_lease(self, key, owner, ttl):
+        return bool(await self._lease_script(keys=[self.prefix + key], args=[owner, int(ttl * 1000)]))
+
+    async def release_lease(self, key, owner):
+        await self._release_script(keys=[self.prefix + key], args=[owner])
+
+    async def hset_json(self, name, field, value):
+        await self.redis.hset(self.prefix + name, field, json.dumps(value))
+
+    async def hdel(self, name, field):
+        await self.redis.hdel(self.prefix + name, field)
+
+    async def hgetall_json(self, name):
+        raw = await self.redis.hgetall(self.prefix + name)
+        return {field: json.loads(value) for field, value in raw.items()}
+
+    async def push(self, queue, value):
+        await self.redis.rpush(self.prefix + queue, json.dumps(value))
+
+    async def pop(self, queue, timeout):
+        item = await self.redis.blpop([self.prefix + queue], timeout=max(int(timeout), 1))
+        return None if item is None else json.loads(item[1])
+
+    async def close(self):
+        await self.redis.aclose()
+
+def create_backend(kind=STATE_BACKEND):
+    if kind == "redis":
+        return RedisBackend()
+    if kind != "memory":
+        raise ValueError(f"STATE_BACKEND inconnu : {kind} (memory ou redis)")
+    return MemoryBackend()
+
+def shared_loader(name, loader, ttl):
+    """Enveloppe un chargeur pour partager son résultat entre workers via le backend"""
+    if not state_backend.shared:
+        return loader
+
+    async def load(*args):
+        key = ":".join(["cache", name, *map(str, args)])
+        try:
+            value = await state_backend.get_json(key)
+        except Exception as e:
+            log.warning("Cache partagé %s: %s", name, e)
+            return await loader(*args)
+        if value is None:
+            value = await loader(*args)
+            if value:
+                try:
+                    await state_backend.set_json(key, value, ttl)
+                except Exception as e:
+                    log.warning("Cache partagé %s: %s", name, e)
+        return value
+    return load
+
+
+state_backend = create_backend()
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# ===== Client HeroSMS =====
+
+_http_client = None
+
+def get_http_client():
+    """Client HTTP partagé (pool keep-alive) pour tous les appels HeroSMS"""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            timeout=DEFAULT_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=HERO_MAX_CONNECTIONS,
+                max_keepalive_connections=HERO_MAX_KEEPALIVE,
+                keepalive_expiry=HERO_KEEPALIVE_EXPIRY,
+            ),
+        )
+    return _http_client
+
+async def close_http_client():
+    """Ferme le pool de connexions HTTP"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+def _is_retryable(response):
+    return response.status_code >= 500
+
+class HeroUnavailable(Exception):
+    """HeroSMS indisponible : disjoncteur ouvert ou quota local épuisé"""
+
+class RateLimiter:
+    """Quota global partagé par toutes les actions, plus un quota par action (un limiteur par compte)"""
+
+    def __init__(self, backend, prefix="ratelimit", rate=HERO_RATE, burst=HERO_BURST, action_rates=ACTION_RATES,
+                 max_wait=HERO_RATE_MAX_WAIT):
+        self.global_bucket = backend.bucket(f"{prefix}:global", rate, burst)
+        self.buckets = {action: backend.bucket(f"{prefix}:{action}", r) for action, r in action_rates.items()}
+        self.max_wait = max_wait
+
+    async def acquire(self, action):
+        started = time.monotonic()
+        bucket = self.buckets.get(action)
+        if bucket and not await bucket.acquire(self.max_wait):
+            return False
+        remaining = self.max_wait - (time.monotonic() - started)
+        if not await self.global_bucket.acquire(max(remaining, 0)):
+            return False
+        if time.monotonic() - started > 0.001:
+            HERO_THROTTLED.labels(action).inc()
+        return True
+
+class CircuitBreaker:
+    """Disjoncteur : coupe les appels après des échecs consécutifs, puis laisse passer une sonde"""
+
+    CLOSED, OPEN, HALF_OPEN = 0, 1, 2
+
+    def __init__(self, name="default", threshold=HERO_BREAKER_THRESHOLD, cooldown=HERO_BREAKER_COOLDOWN):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.probe_at = 0.0
+        self._set_state(self.CLOSED)
+
+    def _set_state(self, state):
+        self.state = state
+        CIRCUIT_STATE.labels(self.name).set(state)
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+            self._set_state(self.HALF_OPEN)
+        # Une seule sonde à la fois (une sonde perdue est remplacée après le délai)
+        if self.state == self.HALF_OPEN and (not self.probing or time.monotonic() - self.probe_at >= self.cooldown):
+            self.probing = True
+            self.probe_at = time.monotonic()
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.probing = False
+        if self.state != self.CLOSED:
+            log.info("HeroSMS répond à nouveau, disjoncteur refermé", extra=fields(
+                event="circuit_closed", account=self.name
+            ))
+            self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.threshold):
+            log.warning(
+                "HeroSMS en échec, disjoncteur ouvert",
+                extra=fields(event="circuit_open", account=self.name, failures=self.failures, cooldown=self.cooldown)
+            )
+            self.opened_at = time.monotonic()
+            self._set_state(self.OPEN)
+            CIRCUIT_TRIPS.labels(self.name).inc()
+
+
+# Enregistrements compacts du catalogue : tuples nommés (pas de __dict__), sérialisables en JSON
+ServiceRecord = namedtuple("ServiceRecord", "code name")
+CountryRecord = namedtuple("CountryRecord", "id eng")
+
+class BodyReader:
+    """Corps de réponse httpx vu comme un fichier asynchrone (pour ijson)"""
+
+    def __init__(self, response):
+        self._chunks = response.aiter_bytes()
+        self._buffer = b""
+
+    async def _fill(self):
+        if not self._buffer:
+            self._buffer = await anext(self._chunks, b"")
+        return self._buffer
+
+    async def peek(self):
+        """Premier caractère significatif, sans le consommer"""
+        while (await self._fill()) and not self._buffer.lstrip():
+            self._buffer = b""
+        return self._buffer.lstrip()[:1]
+
+    async def read(self, size=-1):
+        await self._fill()
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+@functools.cache
+def load_ijson():
+    """ijson est optionnel (sans lui, le catalogue est lu d'un bloc) et importé au premier usage"""
     try:
-        response = requests.get(BASE_URL, params=params, timeout=10)
-        print(f"\n=== API Call: getTopCountriesByService ===")
-        print(f"Service: {service_code}")
-        print(f"HTTP Status: {response.status_code}")
-        
-        data = response.json()
-        
-        if isinstance(data, dict):
-            countries_list = []
-            for key in data.keys():
-                value = data[key]
-                if isinstance(value, dict) and "country" in value:
-                    countries_list.append(value)
-            
-            if countries_list:
-                print(f"✅ Trouvé {len(countries_list)} pays")
+        import ijson
+    except ImportError:
+        return None
+    return ijson
+
+async def json_objects(response, key=None):
+    """Objets d'une réponse JSON lus au fil de l'eau : éléments du tableau `key`,
+    sinon valeurs d'un dict ou éléments d'une liste (corps entier si ijson est absent)"""
+    ijson = load_ijson()
+    if ijson is None:
+        data = json.loads(await response.aread())
+        if key is not None:
+            data = data.get(key, []) if isinstance(data, dict) else []
+        for item in data.values() if isinstance(data, dict) else data:
+            yield item
+        return
+
+    reader = BodyReader(response)
+    if key is not None:
+        items = ijson.items(reader, f"{key}.item")
+    elif await reader.peek() == b"{":
+        items = (value async for _, value in ijson.kvitems(reader, ""))
+    else:
+        items = ijson.items(reader, "item")
+    async for item in items:
+        yield item
+
+class HeroSMSClient:
+    """Client asynchrone pour les actions de handler_api.php"""
+
+    def __init__(self, api_key, limiter, breaker, base_url=BASE_URL):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.limiter = limiter
+        self.breaker = breaker
+        self.last_balance = None
+
+    async def _get(self, action, **params):
+        return await self._send(action, False, params)
+
+    @contextlib.asynccontextmanager
+    async def _stream(self, action, **params):
+        """Comme _get, mais le corps est lu au fil de l'eau par l'appelant"""
+        response = await self._send(action, True, params)
+        try:
+            yield response
+        finally:
+            await response.aclose()
+
+    async def _send(self, action, stream, params):
+        params = {"action": action, **params, "api_key": self.api_key}
+        timeout = ACTION_TIMEOUTS.get(action, DEFAULT_TIMEOUT)
+        retries = HERO_MAX_RETRIES if action in IDEMPOTENT_ACTIONS else 0
+
+        for attempt in range(retries + 1):
+            if not self.breaker.allow():
+                HERO_REJECTED.labels(action, "circuit_open").inc()
+                log.info("HeroSMS refusé", extra=fields(event="hero_rejected", action=action, reason="circuit_open"))
+                raise HeroUnavailable("disjoncteur ouvert")
+            if not await self.limiter.acquire(action):
+                HERO_REJECTED.labels(action, "rate_limited").inc()
+                log.info("HeroSMS refusé", extra=fields(event="hero_rejected", action=action, reason="rate_limited"))
+                raise HeroUnavailable("quota local dépassé")
+            if attempt:
+                HERO_RETRIES.labels(action).inc()
+            started = time.perf_counter()
+            try:
+                client = get_http_client()
+                request = client.build_request("GET", self.base_url, params=params, timeout=timeout)
+                with HERO_IN_FLIGHT.labels(action).track_inprogress(), HERO_LATENCY.labels(action).time():
+                    response = await client.send(request, stream=stream)
+                HERO_RESPONSES.labels(action, response_status(response)).inc()
+                log.info("HeroSMS", extra=fields(
+                    event="hero_call",
+                    action=action,
+                    status=response.status_code,
+                    attempt=attempt,
+                    ms=round((time.perf_counter() - started) * 1000, 1),
+                ))
+                if _is_retryable(response):
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                if attempt == retries or not _is_retryable(response):
+                    return response
+                await response.aclose()
+            except httpx.TransportError as e:
+                HERO_ERRORS.labels(action, type(e).__name__).inc()
+                log.warning("HeroSMS injoignable: %s", type(e).__name__, extra=fields(
+                    event="hero_error", action=action, attempt=attempt
+                ))
+                self.breaker.record_failure()
+                if attempt == retries:
+                    raise
+            # Backoff exponentiel avec "full jitter"
+            await asyncio.sleep(random.uniform(0, HERO_RETRY_BASE_DELAY * 2 ** attempt))
+
+    async def get_balance(self, fallback=True):
+        """Récupère le solde (dernier solde connu si HeroSMS est indisponible, sauf fallback=False)"""
+        try:
+            response = await self._get("getBalance")
+        except HeroUnavailable:
+            if self.last_balance is None or not fallback:
+                raise
+            return self.last_balance
+        balance = response.text.replace("ACCESS_BALANCE:", "")
+        if response.text.startswith("ACCESS_BALANCE:"):
+            self.last_balance = balance
+        return balance
+
+    async def get_all_services(self, lang="en"):
+        """Récupère TOUS les services disponibles (code et nom seulement)"""
+        async with self._stream("getServicesList", lang=lang) as response:
+            return [
+                ServiceRecord(str(s["code"]), str(s["name"]))
+                async for s in json_objects(response, "services")
+                if isinstance(s, dict) and "code" in s and "name" in s
+            ]
+
+    async def get_countries_for_service(self, service_code):
+        """Récupère les pays disponibles pour un service"""
+        try:
+            response = await self._get("getTopCountriesByService", service=service_code)
+            data = response.json()
+
+            if isinstance(data, dict):
+                countries_list = []
+                for key in data.keys():
+                    value = data[key]
+                    if isinstance(value, dict) and "country" in value:
+                        countries_list.append(value)
+
+                if not countries_list:
+                    log.warning("Top pays sans données pays valides", extra=fields(service=service_code))
                 return countries_list
-            else:
-                print(f"⚠️ Dictionnaire reçu mais pas de données pays valides")
-                return []
-        
-        elif isinstance(data, list):
-            print(f"✅ Format liste reçu avec {len(data)} éléments")
-            if len(data) > 0 and isinstance(data[0], dict) and "country" in data[0]:
+
+            elif isinstance(data, list):
+                if len(data) > 0 and isinstance(data[0], dict) and "country" in data[0]:
+                    return data
+                elif len(data) > 0 and isinstance(data[0], dict):
+                    for key, value in data[0].items():
+                        if isinstance(value, list):
+                            return value
+
+            log.warning("Top pays : format non reconnu (%s)", type(data).__name__, extra=fields(service=service_code))
+            return []
+
+        except HeroUnavailable:
+            raise
+        except Exception as e:
+            log.warning("Top pays illisible: %s", e, extra=fields(service=service_code))
+            return []
+
+    async def get_countries(self):
+        """Liste de tous les pays (id et nom anglais seulement)"""
+        async with self._stream("getCountries") as response:
+            return [
+                CountryRecord(c["id"], str(c.get("eng") or f"ID{c['id']}"))
+                async for c in json_objects(response)
+                if isinstance(c, dict) and "id" in c
+            ]
+
+    async def request_number(self, service, country):
+        """Commander un numéro"""
+        response = await self._get("getNumber", service=service, country=country)
+        return response.text
+
+    async def get_sms_code(self, activation_id):
+        """Récupérer le code SMS"""
+        response = await self._get("getStatus", id=activation_id)
+        return response.text
+
+    async def cancel_activation(self, activation_id):
+        """Annuler une activation"""
+        response = await self._get("setStatus", id=activation_id, status=8)
+        return response.text
+
+    async def confirm_sms(self, activation_id):
+        """Confirmer la réception du SMS"""
+        response = await self._get("setStatus", id=activation_id, status=6)
+        return response.text
+
+    async def get_active_activations(self):
+        """Récupérer les activations actives"""
+        try:
+            response = await self._get("getActiveActivations")
+            data = response.json()
+
+            if isinstance(data, dict) and data.get("status") == "success":
+                activations = data.get("activeActivations", [])
+                if isinstance(activations, list):
+                    return activations
+
+            return []
+        except HeroUnavailable:
+            raise
+        except Exception as e:
+            log.warning("Activations actives illisibles: %s", e)
+            return []
+
+    async def get_history(self, limit=10, offset=0, end=None, days=HISTORY_DAYS):
+        """Récupérer l'historique des activations (une page de `limit` à partir de `offset`)"""
+        end = end or int(time.time())
+        try:
+            response = await self._get(
+                "getHistory",
+                start=end - (days * 24 * 3600),
+                end=end,
+                offset=offset,
+                size=limit,
+            )
+            data = response.json()
+
+            if isinstance(data, list):
                 return data
-            elif len(data) > 0 and isinstance(data[0], dict):
-                for key, value in data[0].items():
-                    if isinstance(value, list):
-                        return value
-        
-        print(f"❌ Format non reconnu: {type(data)}")
-        return []
-        
-    except Exception as e:
-        print(f"❌ ERREUR: {e}")
-        return []
-
-def get_countries():
-    """Liste de tous les pays"""
-    params = {"action": "getCountries", "api_key": API_KEY}
-    response = requests.get(BASE_URL, params=params, timeout=10)
-    return response.json()
-
-def request_number(service, country):
-    """Commander un numéro"""
-    params = {
-        "action": "getNumber",
-        "service": service,
-        "country": country,
-        "api_key": API_KEY
-    }
-    response = requests.get(BASE_URL, params=params, timeout=10)
-    return response.text
-
-def get_sms_code(activation_id):
-    """Récupérer le code SMS"""
-    params = {
-        "action": "getStatus",
-        "id": activation_id,
-        "api_key": API_KEY
-    }
-    response = requests.get(BASE_URL, params=params, timeout=10)
-    return response.text
-
-def cancel_activation(activation_id):
-    """Annuler une activation"""
-    params = {
-        "action": "setStatus",
-        "id": activation_id,
-        "status": 8,
-        "api_key": API_KEY
-    }
-    response = requests.get(BASE_URL, params=params, timeout=10)
-    return response.text
-
-def confirm_sms(activation_id):
-    """Confirmer la réception du SMS"""
-    params = {
-        "action": "setStatus",
-        "id": activation_id,
-        "status": 6,
-        "api_key": API_KEY
-    }
-    response = requests.get(BASE_URL, params=params, timeout=10)
-    return response.text
-
-def get_active_activations():
-    """Récupérer les activations actives"""
-    params = {
-        "action": "getActiveActivations",
-        "api_key": API_KEY
-    }
-    try:
-        response = requests.get(BASE_URL, params=params, timeout=10)
-        data = response.json()
-        
-        if isinstance(data, dict) and data.get("status") == "success":
-            activations = data.get("activeActivations", [])
-            if isinstance(activations, list):
-                return activations
-        
-        return []
-    except Exception as e:
-        print(f"Erreur get_active_activations: {e}")
-        return []
-
-def get_history(limit=10):
-    """Récupérer l'historique des activations"""
-    import time
-    params = {
-        "action": "getHistory",
-        "start": int(time.time()) - (7 * 24 * 3600),
-        "end": int(time.time()),
-        "offset": 0,
-        "size": limit,
-        "api_key": API_KEY
-    }
-    try:
-        response = requests.get(BASE_URL, params=params, timeout=10)
-        data = response.json()
-        
-        if isinstance(data, list):
-            return data
-        
-        return []
-    except Exception as e:
-        print(f"Erreur get_history: {e}")
-        return []
+
+            return []
+        except HeroUnavailable:
+            raise
+        except Exception as e:
+            log.warning("Historique illisible: %s", e)
+            return []
+
+
+# ===== Comptes HeroSMS =====
+
+class HeroAccount:
+    """Compte HeroSMS : son client, son solde en cache et ses commandes en cours
+
+    Le solde et ses débits optimistes sont propres au processus : avec plusieurs workers,
+    chacun suit les siens et la réconciliation périodique (getBalance) les remet d'accord.
+    """
+
+    def __init__(self, api_key):
+        # Libellé stable (la clé elle-même n'est jamais stockée ni affichée)
+        self.label = hashlib.sha256((api_key or "").encode()).hexdigest()[:8]
+        # Quotas et disjoncteur propres au compte : une clé saturée ou en erreur ne bride pas les autres
+        self.client = HeroSMSClient(
+            api_key,
+            limiter=RateLimiter(state_backend, prefix=f"ratelimit:{self.label}"),
+            breaker=CircuitBreaker(self.label),
+        )
+        self.balance = None
+        self.balance_at = 0.0
+        self.in_flight = 0
+        # Montant débité localement par activation, recrédité si elle est annulée
+        self.holds = {}
+        self._refresh_lock = asyncio.Lock()
+
+    def _set_balance(self, balance):
+        self.balance = balance
+        ACCOUNT_BALANCE.labels(self.label).set(balance)
+
+    async def refresh_balance(self):
+        """Réconcilie le solde local avec getBalance (un seul appel à la fois)"""
+        if self._refresh_lock.locked():
+            async with self._refresh_lock:
+                return self.balance
+        async with self._refresh_lock:
+            try:
+                # Jamais le dernier solde connu : il effacerait les débits locaux faits depuis
+                text = await self.client.get_balance(fallback=False)
+            except (HeroUnavailable, httpx.HTTPError) as e:
+                log.info("Solde non réconcilié: %s", e, extra=fields(account=self.label))
+                return self.balance
+            try:
+                self._set_balance(float(text))
+            except (TypeError, ValueError):
+                log.warning("Solde illisible: %s", text, extra=fields(account=self.label))
+                return self.balance
+            self.balance_at = time.monotonic()
+            return self.balance
+
+    async def fresh_balance(self, ttl=BALANCE_TTL):
+        """Solde en cache s'il a moins de `ttl` secondes, sinon relu chez HeroSMS"""
+        if self.balance is None or time.monotonic() - self.balance_at >= ttl:
+            await self.refresh_balance()
+        return self.balance
+
+    def debit(self, activation_id, price):
+        """Débit optimiste dès la commande, sans attendre la prochaine réconciliation"""
+        if not price:
+            return
+        self.holds[str(activation_id)] = price
+        if self.balance is not None:
+            self._set_balance(self.balance - price)
+
+    def credit(self, activation_id):
+        """Remboursement local d'une activation annulée"""
+        price = self.holds.pop(str(activation_id), None)
+        if price and self.balance is not None:
+            self._set_balance(self.balance + price)
+
+class KeyPool:
+    """Pool de comptes HeroSMS : routage des commandes selon le solde et la charge"""
+
+    def __init__(self, api_keys):
+        self.accounts = [HeroAccount(key) for key in api_keys]
+        self.by_label = {account.label: account for account in self.accounts}
+        self.primary = self.accounts[0]
+        self.owners = {}
+
+    def pick(self, price=0.0):
+        """Compte au solde suffisant le moins chargé (solde inconnu = on tente)"""
+        funded = [a for a in self.accounts if a.balance is None or a.balance >= price]
+        return min(funded or self.accounts, key=lambda a: (a.in_flight, -(a.balance or 0)))
+
+    def can_afford(self, price):
+        """Au moins un compte peut payer `price` (solde inconnu = on tente)"""
+        return any(a.balance is None or a.balance >= price for a in self.accounts)
+
+    async def request_number(self, service, country, price=0.0):
+        """Commande un numéro sur le meilleur compte ; (réponse, compte)
+
+        Sans solde suffisant nulle part, NO_BALANCE est renvoyé sans appel à HeroSMS.
+        """
+        if price and not self.can_afford(price):
+            return "NO_BALANCE", None
+        account = self.pick(price)
+        account.in_flight += 1
+        ACCOUNT_IN_FLIGHT.labels(account.label).inc()
+        try:
+            result = await account.client.request_number(service, country)
+        finally:
+            account.in_flight -= 1
+            ACCOUNT_IN_FLIGHT.labels(account.label).dec()
+        access = parse_access_number(result)
+        if access:
+            self.bind(access[0], account)
+            account.debit(access[0], price)
+        elif "NO_BALANCE" in result and account.balance is not None:
+            # Le solde local était trop optimiste : on le corrige tout de suite
+            start_background(account.refresh_balance())
+        return result, account
+
+    def bind(self, activation_id, account):
+        """Les appels suivants (getStatus, setStatus) iront au compte créateur"""
+        if isinstance(account, str):
+            account = self.by_label.get(account, self.primary)
+        self.owners[str(activation_id)] = account
+
+    def release(self, activation_id):
+        account = self.owners.pop(str(activation_id), None)
+        if account is not None:
+            account.holds.pop(str(activation_id), None)
+
+    def refund(self, activation_id):
+        """Activation annulée (ACCESS_CANCEL) : le prix retenu est recrédité puis l'activation libérée"""
+        self.account_for(activation_id).credit(activation_id)
+        self.release(activation_id)
+
+    def account_for(self, activation_id):
+        return self.owners.get(str(activation_id), self.primary)
+
+    def client_for(self, activation_id):
+        return self.account_for(activation_id).client
+
+    async def refresh_balances(self):
+        await asyncio.gather(*(a.refresh_balance() for a in self.accounts), return_exceptions=True)
+
+    async def fresh_balances(self):
+        await asyncio.gather(*(a.fresh_balance() for a in self.accounts), return_exceptions=True)
+
+    async def refresh_balances_forever(self, interval=BALANCE_REFRESH_INTERVAL):
+        """Soldes réconciliés en tâche de fond plutôt qu'à chaque clic (le premier : warm_up)"""
+        while True:
+            await asyncio.sleep(interval)
+            await self.refresh_balances()
+
+    async def gather_accounts(self, accounts, call):
+        """[(compte, résultat)] de call(compte) en parallèle ; les comptes en échec sont ignorés
+
+        L'erreur n'est levée que si aucun compte n'a répondu.
+        """
+        accounts = list(accounts)
+        results = await asyncio.gather(*(call(a) for a in accounts), return_exceptions=True)
+        answered, errors = [], []
+        for account, result in zip(accounts, results):
+            if isinstance(result, BaseException):
+                log.warning("Compte ignoré: %s", result, extra=fields(account=account.label))
+                errors.append(result)
+            else:
+                answered.append((account, result))
+        if errors and not answered:
+            raise errors[0]
+        return answered
+
+    async def get_active_activations(self):
+        """Activations actives des comptes joignables (chacune liée à son compte)"""
+        merged = []
+        for account, active in await self.gather_accounts(self.accounts, lambda a: a.client.get_active_activations()):
+            for act in active:
+                self.bind(act.get("activationId", ""), account)
+            merged.extend(active)
+        return merged
+
+    def start(self):
+        start_background(self.refresh_balances_forever())
+
+
+def parse_access_number(result):
+    """(activation_id, numéro) d'une réponse ACCESS_NUMBER:id:numéro, sinon None"""
+    result = result.strip()
+    if not result.startswith("ACCESS_NUMBER"):
+        return None
+    parts = result.split(":")
+    return parts[1], parts[2]
+
+
+key_pool = KeyPool(API_KEYS)
+# Lectures du catalogue : le premier compte suffit
+hero = key_pool.primary.client
+
+# ===== Caches =====
+
+background_tasks = set()
+
+def start_background(coro):
+    """Lance une tâche de fond (gardée en référence jusqu'à sa fin)"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def stop_background():
+    """Annule toutes les tâches de fond"""
+    for task in list(background_tasks):
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+
+class CachedResource:
+    """Valeur en cache avec TTL et rafraîchissement en arrière-plan (stale-while-revalidate)"""
+
+    def __init__(self, name, loader, ttl, on_update=None, snapshot_path=None, dump=None, restore=None):
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self.on_update = on_update
+        self.snapshot_path = snapshot_path
+        # Conversion valeur <-> JSON de l'instantané (telle quelle par défaut)
+        self.dump = dump or (lambda value: value)
+        self.restore = restore or (lambda data: data)
+        self.value = None
+        self.loaded_at = 0.0
+        self._lock = asyncio.Lock()
+        self._refresh_task = None
+
+    def is_fresh(self):
+        return self.value is not None and time.monotonic() - self.loaded_at < self.ttl
+
+    async def get(self):
+        """Valeur fraîche, ou valeur périmée servie pendant qu'on la rafraîchit"""
+        if self.value is None:
+            CACHE_REQUESTS.labels(self.name, "miss").inc()
+            return await self.refresh()
+        if not self.is_fresh():
+            CACHE_REQUESTS.labels(self.name, "stale").inc()
+            self._schedule_refresh()
+        else:
+            CACHE_REQUESTS.labels(self.name, "hit").inc()
+        return self.value
+
+    async def refresh(self, force=False):
+        """Recharge la valeur (les appels concurrents partagent le même chargement)"""
+        async with self._lock:
+            if self.is_fresh() and not force:
+                return self.value
+            value = await self.loader()
+            if value:
+                self.set(value)
+                if self.snapshot_path:
+                    await asyncio.to_thread(self._write_snapshot, value)
+        return self.value
+
+    async def refresh_forever(self, interval):
+        """Rafraîchit la valeur à intervalle régulier"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh(force=True)
+            except Exception as e:
+                log.warning("Rafraîchissement %s échoué: %s", self.name, e)
+
+    def set(self, value, fresh=True):
+        self.value = value
+        self.loaded_at = time.monotonic() if fresh else float("-inf")
+        if self.on_update:
+            self.on_update(value)
+
+    def load_snapshot(self):
+        """Charge le dernier instantané disque (considéré comme périmé)"""
+        if not self.snapshot_path:
+            return False
+        try:
+            with open(self.snapshot_path, encoding="utf-8") as f:
+                value = self.restore(json.load(f))
+        except (OSError, ValueError, TypeError):
+            return False
+        if not value:
+            return False
+        self.set(value, fresh=False)
+        return True
+
+    def _write_snapshot(self, value):
+        os.makedirs(os.path.dirname(self.snapshot_path) or ".", exist_ok=True)
+        tmp_path = f"{self.snapshot_path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.dump(value), f, ensure_ascii=False)
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError as e:
+            log.warning("Instantané %s non écrit: %s", self.name, e)
+
+    def _schedule_refresh(self):
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._background_refresh())
+
+    async def _background_refresh(self):
+        try:
+            await self.refresh()
+        except Exception as e:
+            log.warning("Rafraîchissement %s échoué: %s", self.name, e)
+
+class KeyedCache:
+    """Cache par clé à TTL court, les chargements concurrents d'une même clé sont fusionnés"""
+
+    def __init__(self, name, loader, ttl, max_entries=1000):
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._inflight = {}
+
+    def peek(self, key, stale=False):
+        """Valeur en cache si elle n'a pas expiré (ou même expirée avec stale=True), sinon None"""
+        entry = self._entries.get(key)
+        if entry and (stale or entry[0] > time.monotonic()):
+            return entry[1]
+        return None
+
+    async def get(self, key):
+        value = self.peek(key)
+        if value is not None:
+            CACHE_REQUESTS.labels(self.name, "hit").inc()
+            return value
+        future = self._inflight.get(key)
+        if future is None:
+            CACHE_REQUESTS.labels(self.name, "miss").inc()
+            future = asyncio.ensure_future(self._load(key))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            CACHE_REQUESTS.labels(self.name, "coalesced").inc()
+        # shield : l'annulation d'un appelant n'annule pas la requête partagée
+        return await asyncio.shield(future)
+
+    async def _load(self, key):
+        try:
+            value = await self.loader(key)
+        except HeroUnavailable:
+            # HeroSMS indisponible : on ressert la dernière valeur connue, même expirée
+            entry = self._entries.get(key)
+            if entry is None:
+                raise
+            CACHE_REQUESTS.labels(self.name, "stale").inc()
+            return entry[1]
+        if value:
+            if len(self._entries) >= self.max_entries:
+                self._prune()
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+        return value
+
+    def put(self, key, value):
+        """Alimente le cache de l'extérieur (ex. index des prix rafraîchi en tâche de fond)"""
+        if len(self._entries) >= self.max_entries:
+            self._prune()
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def _prune(self):
+        now = time.monotonic()
+        for key in [k for k, (expires_at, _) in self._entries.items() if expires_at <= now]:
+            del self._entries[key]
+        if len(self._entries) >= self.max_entries:
+            self._entries.clear()
+
+class ServiceIndex:
+    """Index n-grammes (n ≤ 3) des noms et codes de services"""
+
+    NGRAM = 3
+
+    def __init__(self, services):
+        self.services = services
+        self.keys = [(s.name.lower(), s.code.lower()) for s in services]
+        self.grams = defaultdict(set)
+        for i, (name, code) in enumerate(self.keys):
+            for text in (name, code):
+                for n in range(1, self.NGRAM + 1):
+                    for j in range(len(text) - n + 1):
+                        self.grams[text[j:j + n]].add(i)
+
+    def _candidates(self, text):
+        if len(text) <= self.NGRAM:
+            return self.grams.get(text, ())
+        postings = sorted(
+            (self.grams.get(text[j:j + self.NGRAM], set()) for j in range(len(text) - self.NGRAM + 1)),
+            key=len,
+        )
+        candidates = set(postings[0]).intersection(*postings[1:])
+        return [i for i in candidates if text in self.keys[i][0] or text in self.keys[i][1]]
+
+    def _rank(self, text, i):
+        name, code = self.keys[i]
+        if code == text:
+            return (0, i)
+        if name == text:
+            return (1, i)
+        if code.startswith(text) or name.startswith(text):
+            return (2, i)
+        if any(word.startswith(text) for word in name.split()):
+            return (3, i)
+        return (4, i)
+
+    def search(self, text, limit=20):
+        """Services dont le nom ou le code contient `text` (code exact en premier)"""
+        text = text.lower().strip()
+        if not text:
+            return []
+        best = heapq.nsmallest(limit, self._candidates(text), key=lambda i: self._rank(text, i))
+        return [self.services[i] for i in best]
+
+class ServiceCatalog:
+    """Catalogue des services en cache, avec son index de recherche"""
+
+    EMPTY_INDEX = ServiceIndex([])
+
+    def __init__(self, client, ttl=SERVICES_TTL, lang="en", snapshot_dir=SNAPSHOT_DIR):
+        self.client = client
+        self.lang = lang
+        self.resource = CachedResource(
+            "services",
+            self._load,
+            ttl,
+            snapshot_path=os.path.join(snapshot_dir, f"services_{lang}.json"),
+            dump=lambda index: index.services,
+            restore=self._restore,
+        )
+        self._fetch = shared_loader("services", client.get_all_services, ttl)
+
+    async def _load(self):
+        # Depuis le cache partagé, les enregistrements reviennent en listes JSON
+        services = [ServiceRecord._make(s) for s in await self._fetch(self.lang)]
+        if not services:
+            return None
+        # Construction de l'index hors de la boucle d'événements
+        return await asyncio.to_thread(ServiceIndex, services)
+
+    @staticmethod
+    def _restore(rows):
+        # Instantané disque : enregistrements en listes JSON, index reconstruit
+        return ServiceIndex([ServiceRecord._make(r) for r in rows]) if rows else None
+
+    @property
+    def index(self):
+        return self.resource.value or self.EMPTY_INDEX
+
+    async def search(self, text, limit=20):
+        await self.resource.get()
+        return self.index.search(text, limit)
+
+
+class CountryDirectory:
+    """Annuaire des pays partagé par tous les handlers (accès O(1) par id)"""
+
+    def __init__(self, client, refresh_interval=COUNTRIES_REFRESH_INTERVAL, snapshot_dir=SNAPSHOT_DIR):
+        self.client = client
+        self.refresh_interval = refresh_interval
+        self.by_id = {}
+        self._fetch = shared_loader("countries", client.get_countries, refresh_interval)
+        self.resource = CachedResource(
+            "countries",
+            self._load,
+            refresh_interval,
+            on_update=self._reindex,
+            snapshot_path=os.path.join(snapshot_dir, "countries.json"),
+        )
+
+    async def _load(self):
+        return [CountryRecord._make(c) for c in await self._fetch()]
+
+    def _reindex(self, countries):
+        # L'instantané disque relu contient des listes (ou des dicts, ancien format)
+        records = (
+            CountryRecord(c["id"], c.get("eng") or f"ID{c['id']}") if isinstance(c, dict) else CountryRecord._make(c)
+            for c in countries
+        )
+        self.by_id = {c.id: c for c in records}
+
+    async def ensure_loaded(self):
+        await self.resource.get()
+        return self.by_id
+
+    def get(self, country_id):
+        return self.by_id.get(country_id)
+
+    def start(self):
+        """Lance le rafraîchissement périodique (instantané et premier chargement : warm_up)"""
+        start_background(self.resource.refresh_forever(self.refresh_interval))
+
+
+def top_by_stock(countries):
+    return sorted(countries, key=lambda x: x.get("count", 0), reverse=True)[:TOP_COUNTRIES_LIMIT]
+
+async def load_top_countries(service_code):
+    """Top des pays (triés par stock) pour un service"""
+    return top_by_stock(await hero.get_countries_for_service(service_code))
+
+def country_price(service_code, country_id):
+    """Prix affiché pour ce pays (dernier top en cache, même expiré), 0 si inconnu"""
+    for c_data in top_countries.peek(service_code, stale=True) or []:
+        if str(c_data.get("country")) == str(country_id):
+            try:
+                return float(c_data.get("price") or 0)
+            except (TypeError, ValueError):
+                return 0.0
+    return 0.0
+
+
+CountryOffer = namedtuple("CountryOffer", "country price count")
+
+class ServiceOffers:
+    """Offres d'un service, pré-triées pour répondre aux requêtes prix / stock par bisection"""
+
+    def __init__(self, offers):
+        # Par stock décroissant, avec l'offre la moins chère parmi les stocks ≥ au rang courant
+        by_stock = sorted(offers, key=lambda o: -o.count)
+        self.neg_counts = [-o.count for o in by_stock]
+        self.cheapest_prefix = list(itertools.accumulate(by_stock, lambda a, b: b if b.price < a.price else a))
+        # Par prix croissant, avec l'offre au plus gros stock parmi les prix ≤ au rang courant
+        by_price = sorted(offers, key=lambda o: o.price)
+        self.prices = [o.price for o in by_price]
+        self.stocked_prefix = list(itertools.accumulate(by_price, lambda a, b: b if b.count > a.count else a))
+
+    def cheapest(self, min_stock):
+        """Offre la moins chère avec un stock ≥ min_stock"""
+        n = bisect.bisect_right(self.neg_counts, -min_stock)
+        return self.cheapest_prefix[n - 1] if n else None
+
+    def most_stock(self, max_price):
+        """Offre au plus gros stock pour un prix ≤ max_price"""
+        n = bisect.bisect_right(self.prices, max_price)
+        return self.stocked_prefix[n - 1] if n else None
+
+class PriceIndex:
+    """Prix et stock par (service, pays) des services populaires, rafraîchis en tâche de fond
+
+    Les choix de la commande en un clic (moins cher avec stock suffisant, plus gros stock
+    sous un prix) sont calculés à chaque rafraîchissement : leur lecture est un simple accès dict.
+    """
+
+    def __init__(self, client, services=POPULAR_SERVICES, interval=PRICE_INDEX_INTERVAL,
+                 min_stock=QUICK_MIN_STOCK, max_price=QUICK_MAX_PRICE):
+        self.services = services
+        self.interval = interval
+        self.min_stock = min_stock
+        self.max_price = max_price
+        self.offers = {}
+        self.quick = {}
+        self._fetch = shared_loader("price_index", client.get_countries_for_service, interval)
+
+    def update(self, service, countries):
+        offers = []
+        for c in countries:
+            try:
+                offers.append(CountryOffer(c["country"], float(c.get("price") or 0), int(c.get("count") or 0)))
+            except (KeyError, TypeError, ValueError):
+                continue
+        service_offers = ServiceOffers(offers)
+        self.offers[service] = service_offers
+        self.quick[service, "c"] = service_offers.cheapest(self.min_stock)
+        self.quick[service, "s"] = service_offers.most_stock(self.max_price)
+
+    def cheapest(self, service, min_stock):
+        offers = self.offers.get(service)
+        return offers.cheapest(min_stock) if offers else None
+
+    def most_stock(self, service, max_price):
+        offers = self.offers.get(service)
+        return offers.most_stock(max_price) if offers else None
+
+    def quick_pick(self, service, mode):
+        """Pays choisi pour quick_<service>_c (moins cher) ou quick_<service>_s (plus de stock)"""
+        return self.quick.get((service, mode))
+
+    async def refresh(self):
+        for service in self.services:
+            try:
+                countries = await self._fetch(service)
+            except HeroUnavailable:
+                continue
+            if countries:
+                self.update(service, countries)
+                # L'écran pays de ces services est servi sans appel supplémentaire
+                top_countries.put(service, top_by_stock(countries))
+
+    async def refresh_forever(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                log.warning("Index des prix: %s", e)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.services:
+            start_background(self.refresh_forever())
+
+
+service_catalog = ServiceCatalog(hero)
+country_directory = CountryDirectory(hero)
+top_countries = KeyedCache(
+    "top_countries", shared_loader("top_countries", load_top_countries, TOP_COUNTRIES_TTL), TOP_COUNTRIES_TTL
+)
+
+price_index = PriceIndex(hero)
+# Instantané des activations actives, partagé par toutes les pages
+active_snapshot = KeyedCache("active_activations", lambda _: key_pool.get_active_activations(), ACTIVE_SNAPSHOT_TTL)
+
+# ===== Persistance =====
+
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS activations (
+    activation_id TEXT PRIMARY KEY,
+    user_id INTEGER,
+    chat_id INTEGER,
+    message_id INTEGER,
+    service TEXT,
+    country TEXT,
+    phone TEXT,
+    account TEXT,
+    status TEXT NOT NULL,
+    code TEXT,
+    expires_at REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS activations_by_user ON activations (user_id, created_at);
+CREATE INDEX IF NOT EXISTS activations_by_status ON activations (status);
+CREATE TABLE IF NOT EXISTS activation_events (
+    activation_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS activation_events_by_id ON activation_events (activation_id, at);
+CREATE TABLE IF NOT EXISTS user_state (
+    user_id INTEGER PRIMARY KEY,
+    service TEXT,
+    activation_id TEXT,
+    updated_at REAL NOT NULL
+);
+"""
+
+class ActivationStore:
+    """Activations et état des utilisateurs dans SQLite (WAL), écritures groupées"""
+
+    OPEN = "waiting"
+
+    def __init__(self, path=STORE_PATH, flush_interval=STORE_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._db = None
+        self._lock = asyncio.Lock()
+        self._pending = []
+        self._flush_task = None
+
+    async def open(self):
+        await asyncio.to_thread(self._connect)
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(STORE_SCHEMA)
+        columns = {row["name"] for row in self._db.execute("PRAGMA table_info(activations)")}
+        if "account" not in columns:
+            self._db.execute("ALTER TABLE activations ADD COLUMN account TEXT")
+        self._db.commit()
+
+    async def close(self):
+        await self.flush()
+        if self._db is not None:
+            async with self._lock:
+                await asyncio.to_thread(self._db.close)
+            self._db = None
+
+    # --- Écritures (mises en file puis appliquées en une transaction) ---
+
+    def _enqueue(self, sql, params):
+        self._pending.append((sql, params))
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self):
+        """Écrit toutes les opérations en attente"""
+        if not self._pending or self._db is None:
+            return
+        batch, self._pending = self._pending, []
+        async with self._lock:
+            await asyncio.to_thread(self._write, batch)
+
+    def _write(self, batch):
+        with self._db:
+            for sql, params in batch:
+                self._db.execute(sql, params)
+
+    def record_activation(self, activation_id, user_id, chat_id, message_id, service, country, phone, expires_at,
+                          account=None):
+        now = time.time()
+        self._enqueue(
+            "INSERT OR REPLACE INTO activations (activation_id, user_id, chat_id, message_id, service, country,"
+            " phone, account, status, expires_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (str(activation_id), user_id, chat_id, message_id, service, str(country), phone, account, self.OPEN,
+             expires_at, now, now),
+        )
+        self._enqueue(
+            "INSERT INTO activation_events (activation_id, status, at) VALUES (?, ?, ?)",
+            (str(activation_id), self.OPEN, now),
+        )
+
+    def record_status(self, activation_id, status, code=None):
+        """Transition de statut : waiting, received, cancelled, expired"""
+        now = time.time()
+        self._enqueue(
+            "UPDATE activations SET status = ?, code = COALESCE(?, code), updated_at = ? WHERE activation_id = ?",
+            (status, code, now, str(activation_id)),
+        )
+        self._enqueue(
+            "INSERT INTO activation_events (activation_id, status, at) VALUES (?, ?, ?)",
+            (str(activation_id), status, now),
+        )
+
+    def record_user_state(self, user_id, service=None, activation_id=None):
+        self._enqueue(
+            "INSERT INTO user_state (user_id, service, activation_id, updated_at) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT(user_id) DO UPDATE SET service = COALESCE(excluded.service, service),"
+            " activation_id = COALESCE(excluded.activation_id, activation_id), updated_at = excluded.updated_at",
+            (user_id, service, None if activation_id is None else str(activation_id), time.time()),
+        )
+
+    # --- Lectures ---
+
+    async def _fetch(self, sql, params=()):
+        await self.flush()
+        async with self._lock:
+            return await asyncio.to_thread(lambda: self._db.execute(sql, params).fetchall())
+
+    async def open_activations(self):
+        """Activations encore en attente de SMS (pour reprendre la surveillance)"""
+        return await self._fetch("SELECT * FROM activations WHERE status = ?", (self.OPEN,))
+
+    async def get_activation(self, activation_id):
+        rows = await self._fetch("SELECT * FROM activations WHERE activation_id = ?", (str(activation_id),))
+        return rows[0] if rows else None
+
+    async def user_state(self, user_id):
+        rows = await self._fetch("SELECT * FROM user_state WHERE user_id = ?", (user_id,))
+        return rows[0] if rows else None
+
+
+activation_store = ActivationStore()
+
+# ===== Rendu des messages =====
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+WAITING_STATUSES = {"0", "1", "3"}
+
+ACTIVATION_STATUS_TEXT = {
+    "0": "⏳ En attente",
+    "1": "📨 SMS envoyé",
+    "3": "🔄 Redemandé",
+    "4": "✅ Code reçu",
+    "6": "✅ Complété",
+    "8": "❌ Annulé",
+}
+HISTORY_STATUS_TEXT = {
+    "4": "✅ Complété",
+    "6": "✅ Complété",
+    "8": "❌ Annulé",
+}
+
+# Gabarits compilés une fois ; chaque entrée se termine par une ligne vide
+ACTIVATION_LINE = "• {service} - {phone}\n  {status}\n".format
+HISTORY_LINE = "• {phone}\n  {status} - ${cost}\n  {sms}\n".format
+
+MARKDOWN_ESCAPES = str.maketrans({char: "\\" + char for char in "_*`["})
+
+def md(text):
+    """Échappe un texte libre pour parse_mode="Markdown" (une seule passe)"""
+    return str(text).translate(MARKDOWN_ESCAPES)
+
+def code(text):
+    """Texte affiché en `code` (le backtick ne peut pas y être échappé)"""
+    return "`" + str(text).replace("`", "'") + "`"
+
+def status_label(table, status):
+    return table.get(status) or f"Status {status}"
+
+def shorten(text, width):
+    return text if len(text) <= width else text[:width] + "..."
+
+def render_activation_lines(activations):
+    return [
+        ACTIVATION_LINE(
+            service=md(str(act.get("serviceCode", "N/A")).upper()),
+            phone=md(act.get("phoneNumber", "N/A")),
+            status=status_label(ACTIVATION_STATUS_TEXT, str(act.get("activationStatus", "0"))),
+        )
+        for act in activations
+    ]
+
+def render_history_lines(history, sms_width=40):
+    return [
+        HISTORY_LINE(
+            phone=md(h.get("phone", "N/A")),
+            status=status_label(HISTORY_STATUS_TEXT, str(h.get("status", "0"))),
+            cost=md(h.get("cost", 0)),
+            sms=md(shorten(h.get("sms") or "Pas de SMS", sms_width)),
+        )
+        for h in history
+    ]
+
+def chunk_lines(lines, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Regroupe des lignes en messages d'au plus `limit` caractères"""
+    chunks, current, size = [], [], 0
+    for line in lines:
+        # Une ligne plus longue que la limite est coupée net
+        while len(line) > limit:
+            if current:
+                chunks.append("\n".join(current))
+                current, size = [], 0
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if current and size + len(line) + 1 > limit:
+            chunks.append("\n".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += len(line) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks or [""]
+
+async def send_chunks(message, lines, reply_markup=None, parse_mode="Markdown"):
+    """Édite `message` avec le premier morceau puis envoie la suite (clavier sur le dernier)"""
+    chunks = chunk_lines(lines)
+    last = len(chunks) - 1
+    await message.edit_text(
+        chunks[0],
+        reply_markup=reply_markup if last == 0 else None,
+        parse_mode=parse_mode
+    )
+    for i, chunk in enumerate(chunks[1:], 1):
+        await message.reply_text(
+            chunk,
+            reply_markup=reply_markup if i == last else None,
+            parse_mode=parse_mode
+        )
+
+# ===== Claviers =====
+
+# Claviers statiques construits une seule fois (les objets telegram sont immuables)
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💰 Voir mon solde", callback_data="balance")],
+    [InlineKeyboardButton("📱 Commander un numéro", callback_data="order")],
+    [InlineKeyboardButton("📋 Mes activations", callback_data="activations")],
+])
+BACK_MENU_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Menu", callback_data="back_menu")]])
+BACK_ORDER_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Retour", callback_data="order")]])
+BACK_ORDER_BUTTON = InlineKeyboardButton("🔙 Retour", callback_data="order")
+BALANCE_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("💰 Solde", callback_data="balance")]])
+HISTORY_BUTTON = InlineKeyboardButton("📜 Voir historique", callback_data="history")
+BACK_MENU_BUTTON = InlineKeyboardButton("🔙 Menu", callback_data="back_menu")
+HISTORY_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔙 Activations", callback_data="activations")],
+    [InlineKeyboardButton("🏠 Menu", callback_data="back_menu")],
+])
+
+def page_buttons(prefix, page, has_next, token=lambda page: str(page)):
+    """Ligne « ⬅️ / ➡️ » ; callback_data = `<prefix>_<jeton>` (bien sous la limite de 64 octets)"""
+    row = []
+    if page > 0:
+        row.append(InlineKeyboardButton("⬅️ Précédent", callback_data=f"{prefix}_{token(page - 1)}"))
+    if has_next:
+        row.append(InlineKeyboardButton("Suivant ➡️", callback_data=f"{prefix}_{token(page + 1)}"))
+    return row
+
+def country_name(country_id):
+    country = country_directory.get(country_id)
+    return country.eng if country else f"ID{country_id}"
+
+def quick_buttons(service):
+    """Commande en un clic depuis l'index des prix (vide si le service n'y est pas)"""
+    rows = []
+    cheapest = price_index.quick_pick(service, "c")
+    if cheapest:
+        rows.append([InlineKeyboardButton(
+            f"⚡ Moins cher : {country_name(cheapest.country)} • ${cheapest.price:.2f}",
+            callback_data=f"quick_{service}_c"
+        )])
+    stocked = price_index.quick_pick(service, "s")
+    if stocked and stocked != cheapest:
+        rows.append([InlineKeyboardButton(
+            f"📦 Plus de stock : {country_name(stocked.country)} • {stocked.count} nums • ${stocked.price:.2f}",
+            callback_data=f"quick_{service}_s"
+        )])
+    return rows
+
+def activation_markup(activation_id, check_label="🔄 Vérifier SMS"):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(check_label, callback_data=f"check_{activation_id}")],
+        [InlineKeyboardButton("❌ Annuler", callback_data=f"cancel_{activation_id}")],
+    ])
+
+BUSY_TEXT = "⚠️ HeroSMS est momentanément surchargé, réessaie dans quelques secondes."
+
+ORDER_TEXT = (
+    "🔍 *Recherche de service*\n\n"
+    "Tape le nom du service :\n"
+    "• telegram\n"
+    "• crypto\n"
+    "• whatsapp\n"
+    "• google"
+)
+
+# ===== Surveillance des activations =====
+
+class WatchedActivation:
+    """Activation en attente de SMS, liée au message Telegram à mettre à jour"""
+
+    __slots__ = ("activation_id", "chat_id", "message_id", "phone", "service", "expires_at", "status")
+
+    def __init__(self, activation_id, chat_id, message_id=None, phone=None, service=None, expires_at=None):
+        self.activation_id = str(activation_id)
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.phone = phone
+        self.service = service
+        self.expires_at = expires_at or time.time() + ACTIVATION_LIFETIME
+        self.status = "0"
+
+    def to_dict(self):
+        return {
+            "activation_id": self.activation_id,
+            "chat_id": self.chat_id,
+            "message_id": self.message_id,
+            "phone": self.phone,
+            "service": self.service,
+            "expires_at": self.expires_at,
+        }
+
+class ActivationWatcher:
+    """Interroge en lot les activations en attente et pousse le code SMS dès réception"""
+
+    REGISTRY = "watch:activations"
+
+    def __init__(self, pool, store, backend):
+        self.pool = pool
+        self.store = store
+        self.backend = backend
+        self.pending = {}
+        self.unpublished = set()
+        self.interval = WATCH_MIN_INTERVAL
+        self.bot = None
+        self.ticks = 0
+        self._wakeup = asyncio.Event()
+
+    def start(self, bot):
+        self.bot = bot
+        start_background(self._run())
+
+    def watch(self, activation_id, chat_id, message_id=None, phone=None, service=None, expires_at=None):
+        """Ajoute une activation à surveiller"""
+        watched = WatchedActivation(activation_id, chat_id, message_id, phone, service, expires_at)
+        self.pending[watched.activation_id] = watched
+        if self.backend.shared:
+            self.unpublished.add(watched.activation_id)
+        self.interval = WATCH_MIN_INTERVAL
+        self._wakeup.set()
+        return watched
+
+    def unwatch(self, activation_id):
+        activation_id = str(activation_id)
+        if self.backend.shared:
+            self.unpublished.discard(activation_id)
+            start_background(self._unregister(activation_id))
+        return self.pending.pop(activation_id, None)
+
+    @staticmethod
+    def _lease_key(activation_id):
+        return f"lease:activation:{activation_id}"
+
+    async def _unregister(self, activation_id):
+        try:
+            await self.backend.hdel(self.REGISTRY, activation_id)
+            await self.backend.release_lease(self._lease_key(activation_id), WORKER_ID)
+        except Exception as e:
+            log.warning("Registre des activations: %s", e, extra=fields(activation_id=activation_id))
+
+    async def _sync_registry(self):
+        """Plusieurs workers : chaque activation n'est surveillée que par le détenteur de son bail"""
+        for activation_id in list(self.unpublished):
+            watched = self.pending.get(activation_id)
+            self.unpublished.discard(activation_id)
+            if watched is None:
+                continue
+            entry = watched.to_dict()
+            entry["account"] = self.pool.account_for(activation_id).label
+            await self.backend.acquire_lease(self._lease_key(activation_id), WORKER_ID, WATCH_LEASE_TTL)
+            await self.backend.hset_json(self.REGISTRY, activation_id, entry)
+
+        registry = await self.backend.hgetall_json(self.REGISTRY)
+        for activation_id in list(self.pending):
+            if activation_id not in registry and activation_id not in self.unpublished:
+                # Terminée par un autre worker
+                self.pending.pop(activation_id, None)
+        for activation_id, entry in registry.items():
+            if await self.backend.acquire_lease(self._lease_key(activation_id), WORKER_ID, WATCH_LEASE_TTL):
+                if activation_id not in self.pending:
+                    account = entry.pop("account", None)
+                    if account:
+                        self.pool.bind(activation_id, account)
+                    self.pending[activation_id] = WatchedActivation(**entry)
+            else:
+                self.pending.pop(activation_id, None)
+
+    def is_waiting(self, activation_id):
+        return str(activation_id) in self.pending
+
+    async def _run(self):
+        deadline = time.monotonic() + self.interval
+        while True:
+            if not self.pending:
+                self._wakeup.clear()
+                if self.backend.shared:
+                    # Au repos, on guette quand même les activations orphelines des autres workers
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), WATCH_MAX_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+                    await self._sync_safely()
+                    if not self.pending:
+                        continue
+                else:
+                    await self._wakeup.wait()
+                deadline = time.monotonic() + self.interval
+
+            timeout = deadline - time.monotonic()
+            if timeout > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                    # Nouvelle activation : on rapproche la prochaine vérification
+                    deadline = min(deadline, time.monotonic() + self.interval)
+                    continue
+                except asyncio.TimeoutError:
+                    pass
+
+            if self.backend.shared:
+                await self._sync_safely()
+                if not self.pending:
+                    continue
+            self.ticks += 1
+            correlation_id.set(f"watch{self.ticks}")
+            try:
+                changed = await self._tick()
+            except HeroUnavailable:
+                changed = False
+            except Exception as e:
+                log.exception("Surveillance des activations: %s", e)
+                changed = False
+
+            if changed:
+                self.interval = WATCH_MIN_INTERVAL
+            else:
+                self.interval = min(self.interval * WATCH_BACKOFF, WATCH_MAX_INTERVAL)
+            deadline = time.monotonic() + self.interval
+
+    async def _sync_safely(self):
+        try:
+            await self._sync_registry()
+        except Exception as e:
+            log.warning("Registre des activations: %s", e)
+
+    async def _tick(self):
+        """Un seul getActiveActivations par compte pour toutes les activations surveillées"""
+        accounts = {self.pool.account_for(activation_id) for activation_id in self.pending}
+        answered = await self.pool.gather_accounts(accounts, lambda a: a.client.get_active_activations())
+        healthy = {account for account, _ in answered}
+        by_id = {str(a.get("activationId")): a for _, active in answered for a in active}
+        changed = False
+
+        for activation_id, watched in list(self.pending.items()):
+            if self.pool.account_for(activation_id) not in healthy:
+                # Compte injoignable : ses activations attendent le prochain tour
+                continue
+            act = by_id.get(activation_id)
+            if act is not None:
+                status = str(act.get("activationStatus", "0"))
+                changed = changed or status != watched.status
+                watched.status = status
+                if status in WAITING_STATUSES and not act.get("smsCode"):
+                    if time.time() >= watched.expires_at:
+                        await self._expire(watched)
+                        changed = True
+                    continue
+
+            # Activation terminée ou SMS signalé : getStatus donne la réponse exacte
+            status = await self.pool.client_for(activation_id).get_sms_code(activation_id)
+            if "STATUS_OK" in status:
+                await self._deliver(watched, status.replace("STATUS_OK:", ""))
+                changed = True
+            elif "STATUS_CANCEL" in status or "NO_ACTIVATION" in status:
+                self.unwatch(activation_id)
+                self.pool.refund(activation_id)
+                self.store.record_status(activation_id, "cancelled")
+                await self._notify(watched, "❌ Activation annulée", parse_mode=None)
+                changed = True
+            elif time.time() >= watched.expires_at:
+                await self._expire(watched)
+                changed = True
+
+        return changed
+
+    async def _deliver(self, watched, sms_code):
+        self.unwatch(watched.activation_id)
+        self.store.record_status(watched.activation_id, "received", code=sms_code)
+        client = self.pool.client_for(watched.activation_id)
+        self.pool.release(watched.activation_id)
+        # Le code part d'abord ; la confirmation à HeroSMS n'est qu'un plus
+        await self._notify(watched, f"✅ *Code reçu !*\n\n📞 {code(watched.phone)}\n🔢 {code(sms_code)}")
+        try:
+            await client.confirm_sms(watched.activation_id)
+        except (HeroUnavailable, httpx.HTTPError) as e:
+            log.warning("Confirmation du SMS échouée: %s", e, extra=fields(activation_id=watched.activation_id))
+
+    async def _expire(self, watched):
+        try:
+            result = await self.pool.client_for(watched.activation_id).cancel_activation(watched.activation_id)
+        except (HeroUnavailable, httpx.HTTPError) as e:
+            # Toujours surveillée : l'annulation sera retentée au prochain tour
+            log.warning("Annulation à l'expiration échouée: %s", e, extra=fields(activation_id=watched.activation_id))
+            return
+        self.unwatch(watched.activation_id)
+        self.store.record_status(watched.activation_id, "expired")
+        if "ACCESS_CANCEL" in result:
+            self.pool.refund(watched.activation_id)
+            await self._notify(watched, "⌛ Aucun SMS reçu à temps, activation annulée et remboursée", parse_mode=None)
+        else:
+            self.pool.release(watched.activation_id)
+            await self._notify(watched, f"⌛ Activation expirée : {code(result)}")
+
+    async def _notify(self, watched, text, parse_mode="Markdown"):
+        if watched.message_id is not None:
+            try:
+                await self.bot.edit_message_text(
+                    text,
+                    chat_id=watched.chat_id,
+                    message_id=watched.message_id,
+                    reply_markup=BACK_MENU_MARKUP,
+                    parse_mode=parse_mode
+                )
+                return
+            except TelegramError as e:
+                log.warning("Édition impossible: %s", e, extra=fields(activation_id=watched.activation_id))
+        await self.bot.send_message(watched.chat_id, text, reply_markup=BACK_MENU_MARKUP, parse_mode=parse_mode)
+
+
+activation_watcher = ActivationWatcher(key_pool, activation_store, state_backend)
+WATCHED_ACTIVATIONS.set_function(lambda: len(activation_watcher.pending))
 
 # ===== Commandes Telegram =====
 
+async def bind_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Groupe -1 : corrélation de tous les logs (et appels HeroSMS) de cet update"""
+    correlation_id.set(f"u{update.update_id}")
+    log.info("Update", extra=fields(
+        event="update",
+        user=update.effective_user.id if update.effective_user else None,
+        callback=update.callback_query.data if update.callback_query else None,
+    ))
+
+@instrumented(lambda update: "start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Message de bienvenue"""
-    keyboard = [
-        [InlineKeyboardButton("💰 Voir mon solde", callback_data="balance")],
-        [InlineKeyboardButton("📱 Commander un numéro", callback_data="order")],
-        [InlineKeyboardButton("📋 Mes activations", callback_data="activations")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
+    """Message de bienvenue"""
     await update.message.reply_text(
         "🎯 *Bot HeroSMS*\n\n"
         "Bienvenue ! Que veux-tu faire ?",
-        reply_markup=reply_markup,
+        reply_markup=MAIN_MENU_MARKUP,
         parse_mode="Markdown"
     )
 
+@instrumented(lambda update: "search")
 async def search_service(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Recherche de service par mot-clé"""
     query_text = update.message.text.lower()
     
-    all_services = get_all_services(lang="en")
+    try:
+        matching_services = await service_catalog.search(query_text, limit=20)
+    except HeroUnavailable:
+        await update.message.reply_text(BUSY_TEXT)
+        return
     
-    if not all_services:
+    if not service_catalog.index.services:
         await update.message.reply_text("❌ Impossible de récupérer la liste des services.")
         return
     
-    matching_services = [
-        s for s in all_services 
-        if query_text in s["name"].lower() or query_text in s["code"].lower()
-    ]
-    
     if not matching_services:
         await update.message.reply_text(
-            f"❌ Aucun service trouvé pour `{query_text}`\n\n"
+            f"❌ Aucun service trouvé pour {code(query_text)}\n\n"
             "💡 Exemples : telegram, crypto, whatsapp, google",
             parse_mode="Markdown"
         )
         return
     
-    matching_services = matching_services[:20]
-    
-    keyboard = [
-        [InlineKeyboardButton(
-            f"{s['name']} ({s['code']})", 
-            callback_data=f"srv_{s['code']}"
-        )]
-        for s in matching_services
-    ]
-    keyboard.append([InlineKeyboardButton("🔙 Retour", callback_data="order")])
+    keyboard = []
+    for s in matching_services:
+        row = [InlineKeyboardButton(f"{s.name} ({s.code})", callback_data=f"srv_{s.code}")]
+        cheapest = price_index.quick_pick(s.code, "c")
+        if cheapest:
+            # Un clic : numéro commandé directement, sans passer par l'écran pays
+            row.append(InlineKeyboardButton(f"⚡ ${cheapest.price:.2f}", callback_data=f"quick_{s.code}_c"))
+        keyboard.append(row)
+    keyboard.append([BACK_ORDER_BUTTON])
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     
@@ -250,351 +2264,970 @@ async def search_service(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode="Markdown"
     )
 
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Gère les boutons"""
-    query = update.callback_query
-    await query.answer()
-    
-    if query.data == "balance":
-        balance = get_balance()
-        keyboard = [[InlineKeyboardButton("🔙 Menu", callback_data="back_menu")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(
-            f"💰 *Solde :* {balance} USD",
-            reply_markup=reply_markup,
+class BulkOrder:
+    """Commande de N numéros en parallèle (plafonnée), arrêt dès NO_BALANCE / NO_NUMBERS"""
+
+    def __init__(self, service, country, count, concurrency=BULK_CONCURRENCY, price=0.0):
+        self.service = service
+        self.country = country
+        self.price = price
+        self.count = count
+        self.concurrency = concurrency
+        self.numbers = []
+        self.errors = 0
+        self.done = 0
+        self.stop_reason = None
+
+    async def run(self, on_number=None):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def order_one():
+            async with semaphore:
+                if self.stop_reason:
+                    return
+                try:
+                    result, account = await key_pool.request_number(self.service, self.country, self.price)
+                except (HeroUnavailable, httpx.HTTPError):
+                    self.stop_reason = "HeroSMS indisponible"
+                    return
+                finally:
+                    self.done += 1
+                access = parse_access_number(result)
+                if access:
+                    self.numbers.append(access)
+                    if on_number:
+                        on_number(*access, account)
+                elif "NO_BALANCE" in result:
+                    self.stop_reason = "Solde insuffisant"
+                elif "NO_NUMBERS" in result:
+                    self.stop_reason = "Plus de numéros disponibles"
+                else:
+                    self.errors += 1
+
+        await asyncio.gather(*(order_one() for _ in range(self.count)))
+        return self.numbers
+
+    def progress_text(self):
+        return (
+            f"⏳ *Commande groupée* {md(self.service)} / pays {md(self.country)}\n\n"
+            f"🔄 {self.done}/{self.count} traités\n"
+            f"📦 {len(self.numbers)} numéro(s) • {self.errors} erreur(s)"
+        )
+
+    def summary_lines(self):
+        header = f"✅ *{len(self.numbers)}/{self.count} numéros* ({md(self.service)}, pays {md(self.country)})"
+        if self.stop_reason:
+            header += f"\n⛔ Arrêt : {self.stop_reason}"
+        if self.errors:
+            header += f"\n⚠️ {self.errors} erreur(s)"
+        lines = [header, "Les codes arriveront ici automatiquement.", ""]
+        lines += [f"📞 {code(phone)} • 🆔 {code(activation_id)}" for activation_id, phone in self.numbers]
+        return lines
+
+@instrumented(lambda update: "bulk")
+async def bulk_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/bulk <service> <pays> <nombre> : commande plusieurs numéros d'un coup"""
+    try:
+        service, country, count = context.args[0], context.args[1], int(context.args[2])
+    except (IndexError, ValueError):
+        await update.message.reply_text(
+            f"Usage : `/bulk <service> <pays> <nombre>`\nExemple : `/bulk tg 6 20` (max {BULK_MAX})",
             parse_mode="Markdown"
         )
+        return
+    count = max(1, min(count, BULK_MAX))
+    
+    order = BulkOrder(service, country, count, price=country_price(service, country))
+    message = await update.message.reply_text(order.progress_text(), parse_mode="Markdown")
+    chat_id = update.effective_chat.id
+    user_id = update.effective_user.id
+    
+    def track(activation_id, phone, account):
+        watched = activation_watcher.watch(activation_id, chat_id=chat_id, phone=phone, service=service)
+        activation_store.record_activation(
+            activation_id, user_id, chat_id, None, service, country, phone, watched.expires_at, account.label
+        )
+    
+    async def report_progress():
+        shown = None
+        while True:
+            await asyncio.sleep(BULK_PROGRESS_INTERVAL)
+            text = order.progress_text()
+            if text != shown:
+                shown = text
+                # Numéros payés sur disque avant que Telegram ne les annonce
+                await activation_store.flush()
+                try:
+                    await message.edit_text(text, parse_mode="Markdown")
+                except TelegramError:
+                    pass
+    
+    progress = asyncio.create_task(report_progress())
+    try:
+        await order.run(on_number=track)
+    finally:
+        progress.cancel()
+        await activation_store.flush()
+    
+    # Résumé final, découpé si la liste dépasse la limite Telegram
+    await send_chunks(message, order.summary_lines(), reply_markup=BACK_MENU_MARKUP)
+
+# ===== Boutons =====
+
+class CallbackRouter:
+    """Aiguillage O(1) des callbacks : route exacte, sinon préfixe avant le premier « _ »"""
+
+    def __init__(self):
+        self.exact = {}
+        self.prefixes = {}
+
+    def route(self, name, answer=True):
+        """Enregistre un handler pour un callback_data exact"""
+        def decorator(handler):
+            self.exact[name] = (name, handler, answer)
+            return handler
+        return decorator
+
+    def prefix(self, prefix, answer=True):
+        """Enregistre un handler pour les callback_data `<prefix>_<argument>`"""
+        def decorator(handler):
+            self.prefixes[prefix] = (prefix, handler, answer)
+            return handler
+        return decorator
+
+    def resolve(self, data):
+        """(route, handler, répondre d'office, argument) pour un callback_data"""
+        entry = self.exact.get(data)
+        if entry:
+            return (*entry, None)
+        head, sep, arg = data.partition("_")
+        entry = self.prefixes.get(head)
+        if entry and sep:
+            return (*entry, arg)
+        return ("unknown", None, True, None)
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        route, handler, answer, arg = self.resolve(query.data or "")
+        with HANDLER_IN_FLIGHT.track_inprogress(), HANDLER_LATENCY.labels(route).time():
+            try:
+                # Les routes answer=False répondent elles-mêmes (toast/alerte)
+                if answer:
+                    await query.answer()
+                if handler is not None:
+                    await handler(query, context, arg)
+            except HeroUnavailable:
+                HANDLER_ERRORS.labels(route).inc()
+                await self._reply_busy(query, answered=answer)
+            except Exception:
+                HANDLER_ERRORS.labels(route).inc()
+                raise
+
+    async def _reply_busy(self, query, answered):
+        """Réponse immédiate quand HeroSMS est indisponible"""
+        try:
+            if answered:
+                await query.edit_message_text(BUSY_TEXT, reply_markup=BACK_MENU_MARKUP)
+            else:
+                await query.answer(BUSY_TEXT, show_alert=True)
+        except TelegramError:
+            pass
+
+
+router = CallbackRouter()
+button_handler = router.dispatch
+
+@router.route("balance")
+async def show_balance(query, context, arg):
+    # Solde en cache (débité/recrédité localement), getBalance seulement s'il est trop ancien
+    await key_pool.fresh_balances()
+    if len(key_pool.accounts) == 1:
+        balance = key_pool.primary.balance
+        text = f"💰 *Solde :* {balance:.2f} USD" if balance is not None else "💰 *Solde :* indisponible"
+    else:
+        lines = [f"• {code(a.label)} : {a.balance if a.balance is not None else '?'} USD" for a in key_pool.accounts]
+        total = sum(a.balance or 0 for a in key_pool.accounts)
+        text = f"💰 *Solde total :* {total:.2f} USD\n\n" + "\n".join(lines)
+    await query.edit_message_text(
+        text,
+        reply_markup=BACK_MENU_MARKUP,
+        parse_mode="Markdown"
+    )
+
+@router.route("order")
+async def show_order(query, context, arg):
+    await query.edit_message_text(ORDER_TEXT, parse_mode="Markdown")
+
+@router.route("back_menu")
+async def show_menu(query, context, arg):
+    await query.edit_message_text(
+        "🎯 *Bot HeroSMS*\n\nQue veux-tu faire ?",
+        reply_markup=MAIN_MENU_MARKUP,
+        parse_mode="Markdown"
+    )
+
+@router.route("activations")
+async def show_activations(query, context, arg):
+    await show_activations_page(query, context, "0")
+
+@router.prefix("acts")
+async def show_activations_page(query, context, arg):
+    page = int(arg) if arg.isdigit() else 0
+    active = await active_snapshot.get("all")
+    
+    if not isinstance(active, list):
+        log.error("Activations actives : liste attendue, reçu %s", type(active).__name__)
+        active = []
+    
+    if not active:
+        await show_recent_history(query)
+        return
+    
+    start = page * ACTIVATIONS_PAGE_SIZE
+    shown = active[start:start + ACTIVATIONS_PAGE_SIZE]
+    
+    # Seule la page affichée est rendue
+    lines = [f"📋 *Activations en cours* ({len(active)})\n"] + render_activation_lines(shown)
+    keyboard = [
+        [InlineKeyboardButton(
+            f"🔄 Vérifier {act.get('serviceCode', 'N/A')} ({str(act.get('phoneNumber', 'N/A'))[-4:]})",
+            callback_data=f"check_{act.get('activationId', '')}"
+        )]
+        for act in shown
+        if str(act.get("activationStatus", "0")) in WAITING_STATUSES
+    ]
+    
+    nav = page_buttons("acts", page, start + ACTIVATIONS_PAGE_SIZE < len(active))
+    if nav:
+        keyboard.append(nav)
+    keyboard.append([HISTORY_BUTTON])
+    keyboard.append([BACK_MENU_BUTTON])
+    
+    await send_chunks(query.message, lines, reply_markup=InlineKeyboardMarkup(keyboard))
+
+def parse_history_token(arg):
+    """Jeton de page `<compte>.<page>.<fin>` : la fenêtre reste fixe d'une page à l'autre"""
+    try:
+        account, page, end = (int(part) for part in arg.split("."))
+    except ValueError:
+        return 0, 0, int(time.time())
+    # Jeton forgé (valeurs négatives ou hors bornes) : ramené dans les bornes
+    account = min(max(account, 0), len(key_pool.accounts) - 1)
+    return account, max(page, 0), end if end > 0 else int(time.time())
+
+@router.route("history")
+async def show_history(query, context, arg):
+    await render_history_page(query, "")
+
+@router.prefix("hist")
+async def show_history_page(query, context, arg):
+    await render_history_page(query, arg)
+
+async def show_recent_history(query):
+    """Rien en cours : les dernières entrées de l'historique, avec un simple retour au menu"""
+    history = await key_pool.primary.client.get_history(RECENT_HISTORY_SIZE)
+    if not history:
+        await query.edit_message_text("📋 Aucune activation trouvée", reply_markup=BACK_MENU_MARKUP)
+        return
+    lines = [f"📜 *Historique ({RECENT_HISTORY_SIZE} dernières)*\n"] + render_history_lines(history, sms_width=30)
+    await send_chunks(query.message, lines, reply_markup=BACK_MENU_MARKUP)
+
+async def render_history_page(query, arg):
+    account_index, page, end = parse_history_token(arg)
+    account = key_pool.accounts[account_index]
+    
+    # Une entrée de plus pour savoir s'il existe une page suivante
+    history = await account.client.get_history(
+        HISTORY_PAGE_SIZE + 1, offset=page * HISTORY_PAGE_SIZE, end=end
+    )
+    has_next = len(history) > HISTORY_PAGE_SIZE
+    history = history[:HISTORY_PAGE_SIZE]
     
-    elif query.data == "order":
+    if not history and page == 0:
         await query.edit_message_text(
-            "🔍 *Recherche de service*\n\n"
-            "Tape le nom du service :\n"
-            "• telegram\n"
-            "• crypto\n"
-            "• whatsapp\n"
-            "• google",
-            parse_mode="Markdown"
+            "📜 Aucun historique",
+            reply_markup=BACK_MENU_MARKUP
         )
+        return
     
-    elif query.data == "back_menu":
-        keyboard = [
-            [InlineKeyboardButton("💰 Voir mon solde", callback_data="balance")],
-            [InlineKeyboardButton("📱 Commander un numéro", callback_data="order")],
-            [InlineKeyboardButton("📋 Mes activations", callback_data="activations")],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    title = f"📜 *Historique* (page {page + 1})"
+    if len(key_pool.accounts) > 1:
+        title += f" • compte {code(account.label)}"
+    lines = [title + "\n"] + render_history_lines(history)
+    
+    keyboard = []
+    nav = page_buttons("hist", page, has_next, token=lambda p: f"{account_index}.{p}.{end}")
+    if nav:
+        keyboard.append(nav)
+    if len(key_pool.accounts) > 1:
+        # Passage au compte suivant
+        next_account = (account_index + 1) % len(key_pool.accounts)
+        keyboard.append([InlineKeyboardButton("🔁 Autre compte", callback_data=f"hist_{next_account}.0.{end}")])
+    keyboard += HISTORY_MARKUP.inline_keyboard
+    
+    await send_chunks(query.message, lines, reply_markup=InlineKeyboardMarkup(keyboard))
+
+@router.prefix("srv")
+async def choose_service(query, context, service_code):
+    context.user_data["service"] = service_code
+    activation_store.record_user_state(query.from_user.id, service=service_code)
+    
+    if top_countries.peek(service_code) is None:
+        await query.edit_message_text("⏳ Recherche des pays...")
+    
+    countries_data = await top_countries.get(service_code)
+    
+    if not countries_data:
         await query.edit_message_text(
-            "🎯 *Bot HeroSMS*\n\nQue veux-tu faire ?",
-            reply_markup=reply_markup,
+            f"❌ Pas de pays pour {code(service_code)}",
+            reply_markup=BACK_ORDER_MARKUP,
             parse_mode="Markdown"
         )
+        return
     
-    elif query.data == "activations":
-        active = get_active_activations()
-        
-        if not isinstance(active, list):
-            print(f"ERREUR: active n'est pas une liste, c'est un {type(active)}")
-            active = []
+    country_dict = await country_directory.ensure_loaded()
+    
+    keyboard = quick_buttons(service_code)
+    for c_data in countries_data:
+        country_id = c_data.get("country")
+        country_info = country_dict.get(country_id)
         
-        if active:
-            message = "📋 *Activations en cours*\n\n"
-            keyboard = []
-            
-            for act in active[:5]:
-                phone = act.get("phoneNumber", "N/A")
-                service = act.get("serviceCode", "N/A")
-                status = act.get("activationStatus", "0")
-                act_id = act.get("activationId", "")
-                
-                status_text = {
-                    "0": "⏳ En attente",
-                    "1": "📨 SMS envoyé",
-                    "3": "🔄 Redemandé",
-                    "4": "✅ Code reçu",
-                    "6": "✅ Complété",
-                    "8": "❌ Annulé"
-                }.get(status, f"Status {status}")
-                
-                message += f"• {service.upper()} - {phone}\n  {status_text}\n\n"
-                
-                if status in ["0", "1", "3"]:
-                    keyboard.append([
-                        InlineKeyboardButton(
-                            f"🔄 Vérifier {service} ({phone[-4:]})",
-                            callback_data=f"check_{act_id}"
-                        )
-                    ])
-            
-            keyboard.append([InlineKeyboardButton("📜 Voir historique", callback_data="history")])
-            keyboard.append([InlineKeyboardButton("🔙 Menu", callback_data="back_menu")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
+        if country_info:
+            name = country_info.eng
+            count = c_data.get("count", 0)
+            price = c_data.get("price", 0)
             
-            await query.edit_message_text(
-                message,
-                reply_markup=reply_markup,
-                parse_mode="Markdown"
-            )
-        else:
-            history = get_history(5)
-            
-            if history:
-                message = "📜 *Historique (5 dernières)*\n\n"
-                for h in history:
-                    phone = h.get("phone", "N/A")
-                    sms = h.get("sms") or "Pas de SMS"
-                    cost = h.get("cost", 0)
-                    status = h.get("status", "0")
-                    
-                    status_text = {
-                        "4": "✅ Complété",
-                        "6": "✅ Complété",
-                        "8": "❌ Annulé"
-                    }.get(status, f"Status {status}")
-                    
-                    if sms and len(sms) > 30:
-                        sms_short = sms[:30] + "..."
-                    else:
-                        sms_short = sms
-                    
-                    message += f"• {phone}\n  {status_text} - ${cost}\n  {sms_short}\n\n"
-                
-                keyboard = [[InlineKeyboardButton("🔙 Menu", callback_data="back_menu")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await query.edit_message_text(
-                    message,
-                    reply_markup=reply_markup,
-                    parse_mode="Markdown"
-                )
-            else:
-                keyboard = [[InlineKeyboardButton("🔙 Menu", callback_data="back_menu")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await query.edit_message_text(
-                    "📋 Aucune activation trouvée",
-                    reply_markup=reply_markup
+            keyboard.append([
+                InlineKeyboardButton(
+                    f"{name} • {count} nums • ${price:.2f}",
+                    callback_data=f"ctry_{country_id}"
                 )
+            ])
     
-    elif query.data == "history":
-        history = get_history(10)
-        
-        if history:
-            message = "📜 *Historique (10 dernières)*\n\n"
-            for h in history:
-                phone = h.get("phone", "N/A")
-                sms = h.get("sms") or "Pas de SMS"
-                cost = h.get("cost", 0)
-                status = h.get("status", "0")
-                
-                status_text = {
-                    "4": "✅ Complété",
-                    "6": "✅ Complété", 
-                    "8": "❌ Annulé"
-                }.get(status, f"Status {status}")
-                
-                if sms and len(sms) > 40:
-                    sms_short = sms[:40] + "..."
-                else:
-                    sms_short = sms
-                
-                message += f"• {phone}\n  {status_text} - ${cost}\n  {sms_short}\n\n"
-            
-            keyboard = [
-                [InlineKeyboardButton("🔙 Activations", callback_data="activations")],
-                [InlineKeyboardButton("🏠 Menu", callback_data="back_menu")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                message,
-                reply_markup=reply_markup,
-                parse_mode="Markdown"
-            )
-        else:
-            keyboard = [[InlineKeyboardButton("🔙 Menu", callback_data="back_menu")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(
-                "📜 Aucun historique",
-                reply_markup=reply_markup
-            )
+    if not keyboard:
+        await query.edit_message_text(
+            f"❌ Erreur affichage pays",
+            reply_markup=BACK_ORDER_MARKUP
+        )
+        return
     
-    elif query.data.startswith("srv_"):
-        service_code = query.data.replace("srv_", "")
-        context.user_data["service"] = service_code
-        
-        await query.edit_message_text("⏳ Recherche des pays...")
-        
-        countries_data = get_countries_for_service(service_code)
-        
-        if not countries_data:
-            keyboard = [[InlineKeyboardButton("🔙 Retour", callback_data="order")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(
-                f"❌ Pas de pays pour `{service_code}`",
-                reply_markup=reply_markup,
-                parse_mode="Markdown"
-            )
-            return
-        
-        all_countries = get_countries()
-        country_dict = {c["id"]: c for c in all_countries}
-        
-        countries_data.sort(key=lambda x: x.get("count", 0), reverse=True)
-        countries_data = countries_data[:15]
+    keyboard.append([BACK_ORDER_BUTTON])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    await query.edit_message_text(
+        f"🌍 *Pays pour {md(service_code)}*\n\nChoisis :",
+        reply_markup=reply_markup,
+        parse_mode="Markdown"
+    )
+
+@router.prefix("ctry")
+async def choose_country(query, context, country_id):
+    service = context.user_data.get("service")
+    
+    if not service:
+        # Après un redémarrage, le service choisi est relu depuis la base
+        state = await activation_store.user_state(query.from_user.id)
+        service = state["service"] if state else None
+        context.user_data["service"] = service
+    
+    if not service:
+        await query.edit_message_text("❌ Erreur. /start pour recommencer")
+        return
+    
+    await place_order(query, context, service, country_id, country_price(service, country_id))
+
+@router.prefix("quick")
+async def quick_order(query, context, arg):
+    """Commande en un clic : le pays vient de l'index des prix, sans écran pays"""
+    service, _, mode = arg.rpartition("_")
+    pick = price_index.quick_pick(service, mode)
+    if pick is None:
+        # Plus d'offre qui convient : retour à l'écran pays classique
+        await choose_service(query, context, service)
+        return
+    
+    context.user_data["service"] = service
+    activation_store.record_user_state(query.from_user.id, service=service)
+    await place_order(query, context, service, pick.country, pick.price)
+
+async def place_order(query, context, service, country_id, price):
+    """Commande un numéro et affiche le résultat dans le message du bouton"""
+    if not key_pool.can_afford(price):
+        # Refus immédiat, sans aller-retour HeroSMS
+        await query.edit_message_text(
+            f"❌ Solde insuffisant (prix : ${price:.2f})",
+            reply_markup=BALANCE_MARKUP
+        )
+        return
+    
+    await query.edit_message_text(f"⏳ Commande...", parse_mode="Markdown")
+    
+    result, account = await key_pool.request_number(service, country_id, price)
+    log.info("Commande", extra=fields(event="order", service=service, country=country_id, result=result))
+    
+    access = parse_access_number(result)
+    if access:
+        activation_id, phone_number = access
         
-        keyboard = []
-        for c_data in countries_data:
-            country_id = c_data.get("country")
-            country_info = country_dict.get(country_id)
-            
-            if country_info:
-                name = country_info.get("eng", f"ID{country_id}")
-                count = c_data.get("count", 0)
-                price = c_data.get("price", 0)
-                
-                keyboard.append([
-                    InlineKeyboardButton(
-                        f"{name} • {count} nums • ${price:.2f}",
-                        callback_data=f"ctry_{country_id}"
-                    )
-                ])
+        context.user_data["activation_id"] = activation_id
         
-        if not keyboard:
-            keyboard = [[InlineKeyboardButton("🔙 Retour", callback_data="order")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(
-                f"❌ Erreur affichage pays",
-                reply_markup=reply_markup
-            )
-            return
+        # Numéro payé : surveillé et écrit sur disque avant tout appel Telegram (qui peut échouer)
+        watched = activation_watcher.watch(
+            activation_id,
+            chat_id=query.message.chat_id,
+            message_id=query.message.message_id,
+            phone=phone_number,
+            service=service
+        )
+        activation_store.record_activation(
+            activation_id, query.from_user.id, watched.chat_id, watched.message_id,
+            service, country_id, phone_number, watched.expires_at, account.label
+        )
+        activation_store.record_user_state(query.from_user.id, activation_id=activation_id)
+        await activation_store.flush()
+        active_snapshot.invalidate("all")
         
-        keyboard.append([InlineKeyboardButton("🔙 Retour", callback_data="order")])
+        await query.edit_message_text(
+            f"✅ *Numéro reçu !*\n\n"
+            f"📞 {code(phone_number)}\n"
+            f"🆔 {code(activation_id)}\n\n"
+            f"Utilise-le, le code s'affichera ici automatiquement",
+            reply_markup=activation_markup(activation_id),
+            parse_mode="Markdown"
+        )
+    elif "NO_NUMBERS" in result:
+        keyboard = [[InlineKeyboardButton("🔙 Réessayer", callback_data=f"srv_{service}")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        
         await query.edit_message_text(
-            f"🌍 *Pays pour {service_code}*\n\nChoisis :",
-            reply_markup=reply_markup,
+            "❌ Plus de numéros disponibles",
+            reply_markup=reply_markup
+        )
+    elif "NO_BALANCE" in result:
+        await query.edit_message_text(
+            "❌ Solde insuffisant",
+            reply_markup=BALANCE_MARKUP
+        )
+    else:
+        await query.edit_message_text(
+            f"❌ Erreur : {code(result)}",
+            reply_markup=BACK_MENU_MARKUP,
             parse_mode="Markdown"
         )
+
+NOT_OWNER_TEXT = "⛔ Cette activation ne t'appartient pas"
+
+async def owned_by_other(query, activation_id):
+    """Activation commandée par un autre utilisateur (celles absentes de la base restent accessibles)"""
+    row = await activation_store.get_activation(activation_id)
+    return row is not None and row["user_id"] != query.from_user.id
+
+@router.prefix("check", answer=False)
+async def check_sms(query, context, activation_id):
+    if activation_watcher.is_waiting(activation_id):
+        # Déjà surveillée : pas d'appel HeroSMS, le code arrivera tout seul
+        await query.answer("⏳ Pas encore reçu, le code s'affichera automatiquement", show_alert=True)
+        return
+    if await owned_by_other(query, activation_id):
+        await query.answer(NOT_OWNER_TEXT, show_alert=True)
+        return
     
-    elif query.data.startswith("ctry_"):
-        country_id = query.data.replace("ctry_", "")
-        service = context.user_data.get("service")
+    client = key_pool.client_for(activation_id)
+    status = await client.get_sms_code(activation_id)
+    
+    if "STATUS_OK" in status:
+        await query.answer()
+        sms_code = status.replace("STATUS_OK:", "")
+        activation_store.record_status(activation_id, "received", code=sms_code)
+        key_pool.release(activation_id)
         
-        if not service:
-            await query.edit_message_text("❌ Erreur. /start pour recommencer")
+        # Le code s'affiche d'abord ; la confirmation à HeroSMS n'est qu'un plus
+        await query.edit_message_text(
+            f"✅ *Code reçu !*\n\n🔢 {code(sms_code)}",
+            reply_markup=BACK_MENU_MARKUP,
+            parse_mode="Markdown"
+        )
+        try:
+            await client.confirm_sms(activation_id)
+        except (HeroUnavailable, httpx.HTTPError) as e:
+            log.warning("Confirmation du SMS échouée: %s", e, extra=fields(activation_id=activation_id))
+    elif "STATUS_WAIT_CODE" in status:
+        await query.answer("⏳ Pas encore reçu", show_alert=True)
+    else:
+        await query.answer()
+        await query.edit_message_text(
+            f"⚠️ Statut : {code(status)}",
+            reply_markup=activation_markup(activation_id, check_label="🔄 Réessayer"),
+            parse_mode="Markdown"
+        )
+
+@router.prefix("cancel")
+async def cancel(query, context, activation_id):
+    if await owned_by_other(query, activation_id):
+        await query.edit_message_text(NOT_OWNER_TEXT, reply_markup=BACK_MENU_MARKUP)
+        return
+    
+    result = await key_pool.client_for(activation_id).cancel_activation(activation_id)
+    
+    if "ACCESS_CANCEL" in result:
+        activation_watcher.unwatch(activation_id)
+        key_pool.refund(activation_id)
+        active_snapshot.invalidate("all")
+        activation_store.record_status(activation_id, "cancelled")
+        await query.edit_message_text(
+            "✅ Annulé, argent remboursé",
+            reply_markup=BACK_MENU_MARKUP
+        )
+    else:
+        await query.edit_message_text(
+            f"⚠️ {code(result)}",
+            reply_markup=BACK_MENU_MARKUP,
+            parse_mode="Markdown"
+        )
+
+# ===== Envois Telegram =====
+
+class PendingEdit:
+    """Édition en attente de son tour : appel le plus récent et futur de son appelant"""
+
+    __slots__ = ("call", "future")
+
+    def __init__(self, call, future):
+        self.call = call
+        self.future = future
+
+class OutboundLimiter(BaseRateLimiter):
+    """Régule les appels sortants vers l'API Bot (limites anti-flood de Telegram)
+
+    Seau global + seau par chat pour les envois et éditions ; une édition encore en attente
+    est remplacée par une plus récente du même message (l'état intermédiaire n'est jamais
+    envoyé) ; un RetryAfter suspend tous les envois du processus pendant la durée demandée.
+    """
+
+    def __init__(self, backend, global_rate=TG_GLOBAL_RATE, chat_rate=TG_CHAT_RATE, chat_burst=TG_CHAT_BURST,
+                 max_retries=TG_MAX_RETRIES):
+        self.global_bucket = backend.bucket("telegram:global", global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.chat_buckets = {}
+        self.pending_edits = {}
+        self.blocked_until = 0.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= TG_CHAT_BUCKETS_MAX:
+                # Seaux pleins = chats inactifs : on peut les oublier
+                for key in [k for k, b in self.chat_buckets.items() if b.tokens >= b.capacity]:
+                    del self.chat_buckets[key]
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _wait_turn(self, chat_id, paced):
+        delay = self.blocked_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if paced:
+            await self._chat_bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+
+    async def _send(self, callback, args, kwargs, endpoint, chat_id, paced):
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                await self._wait_turn(chat_id, paced)
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                TELEGRAM_OUTBOUND.labels(endpoint, "retry_after").inc()
+                # Tout le processus se met en pause, pas seulement cet appel
+                self.blocked_until = max(self.blocked_until, time.monotonic() + e.retry_after)
+                log.warning("Telegram : RetryAfter %ss", e.retry_after, extra=fields(endpoint=endpoint))
+                if attempt == self.max_retries:
+                    raise
+                continue
+            TELEGRAM_OUTBOUND.labels(endpoint, "sent").inc()
+            return result
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        paced = endpoint in PACED_ENDPOINTS and chat_id is not None
+        if endpoint not in COALESCED_ENDPOINTS:
+            await self._wait_turn(chat_id, paced)
+            return await self._send(callback, args, kwargs, endpoint, chat_id, paced)
+
+        key = (chat_id, data.get("message_id"), data.get("inline_message_id"))
+        own = asyncio.get_running_loop().create_future()
+        pending = self.pending_edits.get(key)
+        if pending is not None:
+            # Une édition de ce message attend déjà son tour : elle enverra celle-ci à sa place
+            superseded, pending.future = pending.future, own
+            pending.call = (callback, args, kwargs)
+            superseded.set_result(True)
+            TELEGRAM_OUTBOUND.labels(endpoint, "coalesced").inc()
+            return await own
+
+        pending = self.pending_edits[key] = PendingEdit((callback, args, kwargs), own)
+        try:
+            await self._wait_turn(chat_id, paced)
+        except BaseException:
+            if pending.future is not own:
+                pending.future.cancel()
+            raise
+        finally:
+            del self.pending_edits[key]
+
+        # Envoie la dernière version demandée, dont l'appelant reçoit le résultat
+        callback, args, kwargs = pending.call
+        try:
+            result = await self._send(callback, args, kwargs, endpoint, chat_id, paced)
+        except Exception as e:
+            if pending.future is own:
+                raise
+            pending.future.set_exception(e)
+            return own.result()
+        if pending.future is own:
+            return result
+        pending.future.set_result(result)
+        return own.result()
+
+# ===== Ordonnancement des updates =====
+
+class ChatLane:
+    """File d'un chat : updates en attente ou en cours, callbacks déjà programmés,
+    et si l'utilisateur a déjà été prévenu d'un message ignoré"""
+
+    __slots__ = ("lock", "size", "callbacks", "warned")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.size = 0
+        self.callbacks = set()
+        self.warned = False
+
+class ChatScheduler(BaseUpdateProcessor):
+    """Ordonnanceur équitable : un update à la fois par chat (file bornée), plafond global,
+    callbacks identiques fusionnés, délestage signalé (toast, ou réponse pour un message)"""
+
+    def __init__(self, max_running=SCHED_MAX_RUNNING, chat_queue=SCHED_CHAT_QUEUE):
+        # La borne de PTB ne sert que de garde-fou : la régulation se fait ici, par chat
+        super().__init__(max_concurrent_updates=SCHED_MAX_PENDING)
+        self.slots = asyncio.Semaphore(max_running)
+        self.chat_queue = chat_queue
+        self.lanes = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @staticmethod
+    def _chat_key(update):
+        if not isinstance(update, Update):
+            return None
+        chat = update.effective_chat or update.effective_user
+        return chat.id if chat else None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._chat_key(update)
+        if key is None:
+            async with self.slots:
+                await coroutine
             return
-        
-        await query.edit_message_text(f"⏳ Commande...", parse_mode="Markdown")
-        
-        result = request_number(service, country_id)
-        print(f"Résultat: {result}")
-        
-        if "ACCESS_NUMBER" in result:
-            parts = result.split(":")
-            activation_id = parts[1]
-            phone_number = parts[2]
-            
-            context.user_data["activation_id"] = activation_id
-            
-            keyboard = [
-                [InlineKeyboardButton("🔄 Vérifier SMS", callback_data=f"check_{activation_id}")],
-                [InlineKeyboardButton("❌ Annuler", callback_data=f"cancel_{activation_id}")],
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                f"✅ *Numéro reçu !*\n\n"
-                f"📞 `{phone_number}`\n"
-                f"🆔 `{activation_id}`\n\n"
-                f"Utilise-le puis clique 'Vérifier SMS'",
-                reply_markup=reply_markup,
-                parse_mode="Markdown"
-            )
-        elif "NO_NUMBERS" in result:
-            keyboard = [[InlineKeyboardButton("🔙 Réessayer", callback_data=f"srv_{service}")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(
-                "❌ Plus de numéros disponibles",
-                reply_markup=reply_markup
-            )
-        elif "NO_BALANCE" in result:
-            keyboard = [[InlineKeyboardButton("💰 Solde", callback_data="balance")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(
-                "❌ Solde insuffisant",
-                reply_markup=reply_markup
-            )
-        else:
-            keyboard = [[InlineKeyboardButton("🔙 Menu", callback_data="back_menu")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(
-                f"❌ Erreur : `{result}`",
-                reply_markup=reply_markup,
-                parse_mode="Markdown"
-            )
+
+        lane = self.lanes.get(key)
+        if lane is None:
+            lane = self.lanes[key] = ChatLane()
+        data = update.callback_query.data if update.callback_query else None
+        if data is not None and data in lane.callbacks:
+            # Même bouton déjà programmé pour ce chat : une seule exécution
+            await self._shed(update, coroutine, "duplicate", "⏳ Déjà en cours…")
+            return
+        if lane.size >= self.chat_queue:
+            await self._shed(update, coroutine, "chat_full", "🐢 Doucement ! Trop de demandes en attente.", lane)
+            return
+
+        lane.size += 1
+        if data is not None:
+            lane.callbacks.add(data)
+        SCHED_QUEUED.inc()
+        try:
+            async with lane.lock:
+                SCHED_QUEUED.dec()
+                async with self.slots:
+                    await coroutine
+        finally:
+            lane.size -= 1
+            lane.callbacks.discard(data)
+            if not lane.size:
+                self.lanes.pop(key, None)
+
+    async def _shed(self, update, coroutine, reason, text, lane=None):
+        coroutine.close()
+        SCHED_SHED.labels(reason).inc()
+        try:
+            if update.callback_query:
+                await update.callback_query.answer(text)
+            elif update.message and lane is not None and not lane.warned:
+                # Une recherche ignorée se signale par une réponse, une seule fois tant que la file est pleine
+                lane.warned = True
+                await update.message.reply_text(f"{text}\nRenvoie ta recherche dans un instant.")
+        except TelegramError:
+            pass
+
+# ===== Main =====
+
+async def timed_step(step, coroutine):
+    """Exécute une étape du démarrage et note sa durée (une erreur ne bloque pas le démarrage)"""
+    started = time.perf_counter()
+    try:
+        await coroutine
+    except Exception as e:
+        log.warning("Démarrage %s: %s", step, e)
+    bot_state.record(step, time.perf_counter() - started)
+
+async def warm_up():
+    """Démarrage à froid : instantanés disque tout de suite, puis HeroSMS en parallèle
+
+    Le bot est « chaud » dès que catalogue et pays sont servis depuis le disque ; sinon
+    quand les premiers appels HeroSMS (catalogue, pays, soldes) sont revenus.
+    """
+    resources = (service_catalog.resource, country_directory.resource)
+    started = time.perf_counter()
+    loaded = await asyncio.gather(*(asyncio.to_thread(r.load_snapshot) for r in resources))
+    bot_state.record("snapshots", time.perf_counter() - started)
+    if all(loaded):
+        bot_state.warm.set()
+    await asyncio.gather(
+        timed_step("getServicesList", service_catalog.resource.refresh()),
+        timed_step("getCountries", country_directory.resource.refresh()),
+        timed_step("getBalance", key_pool.refresh_balances()),
+    )
+    bot_state.warm.set()
+    log.info(
+        "Caches préchauffés",
+        extra=fields(from_disk=[r.name for r, ok in zip(resources, loaded) if ok], **bot_state.profile),
+    )
+
+async def wait_warm(timeout=STARTUP_WARMUP_TIMEOUT):
+    """Attend le préchauffage, sans rester indisponible si HeroSMS ne répond pas"""
+    try:
+        await asyncio.wait_for(bot_state.warm.wait(), timeout)
+    except asyncio.TimeoutError:
+        log.warning("Préchauffage incomplet après %ss, le bot est déclaré prêt quand même", timeout)
+
+def mark_ready():
+    """Le processus accepte du trafic : profil de démarrage complet journalisé"""
+    bot_state.ready = True
+    bot_state.record("ready", time.perf_counter() - IMPORT_STARTED)
+    log.info("Démarrage terminé", extra=fields(**bot_state.profile))
+
+async def start_services(application):
+    """Démarre les caches partagés et reprend les activations en cours"""
+    start_background(warm_up())
+    country_directory.start()
+    key_pool.start()
+    price_index.start()
+    await activation_store.open()
+    for row in await activation_store.open_activations():
+        if row["account"]:
+            key_pool.bind(row["activation_id"], row["account"])
+        activation_watcher.watch(
+            row["activation_id"],
+            chat_id=row["chat_id"],
+            message_id=row["message_id"],
+            phone=row["phone"],
+            service=row["service"],
+            expires_at=row["expires_at"]
+        )
+    if activation_watcher.pending:
+        log.info("%d activation(s) reprises depuis la base", len(activation_watcher.pending))
+    activation_watcher.start(application.bot)
+
+async def close_clients(application):
+    """Ferme proprement les connexions HeroSMS à l'arrêt"""
+    await stop_background()
+    await activation_store.close()
+    await close_http_client()
+    await state_backend.close()
+
+# ===== Workers =====
+
+def update_chat_id(data):
+    """Chat d'un update brut (message, bouton…), à défaut l'expéditeur puis l'update_id"""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        if value.get("from"):
+            return value["from"]["id"]
+    return data.get("update_id", 0)
+
+def update_queue_name(data, workers=WORKERS):
+    """Partition par chat : tous les updates d'un chat vont au même worker"""
+    return f"updates:{update_chat_id(data) % workers}"
+
+async def push_update(data):
+    """Ingress : l'update brut est confié au worker de son chat"""
+    await state_backend.push(update_queue_name(data), data)
+
+async def process_scheduled(application, update):
+    """Passe par l'ordonnanceur de l'application (ordre par chat, plafond global)"""
+    try:
+        await application.update_processor.process_update(update, application.process_update(update))
+    except Exception as e:
+        log.exception("Update %s: %s", update.update_id, e)
+
+async def consume_updates(application, index):
+    """Worker : dépile sa partition ; l'ordonnanceur garde l'ordre des updates d'un même chat"""
+    queue_name = f"updates:{index}"
+    running = set()
+    while True:
+        try:
+            data = await state_backend.pop(queue_name, timeout=5)
+        except Exception as e:
+            log.warning("File %s: %s", queue_name, e)
+            await asyncio.sleep(1)
+            continue
+        if data is None:
+            continue
+        try:
+            update = Update.de_json(data, application.bot)
+        except Exception as e:
+            log.warning("Update illisible: %s", e, extra=fields(update_id=data.get("update_id")))
+            continue
+        task = asyncio.create_task(process_scheduled(application, update))
+        running.add(task)
+        task.add_done_callback(running.discard)
+
+async def run_worker(index):
+    """Worker : traite les updates de sa partition et surveille ses activations"""
+    application = build_application(updater=False)
+    # Routes de santé servies dès maintenant : vivant pendant le préchauffage, prêt ensuite
+    serving = None
+    if WORKER_PORT:
+        server = create_server(create_web_app(application, webhook=False), WORKER_PORT + index)
+        serving = asyncio.create_task(server.serve())
+
+    async with application:
+        await start_services(application)
+        await application.start()
+        consumer = asyncio.create_task(consume_updates(application, index))
+        log.info("Worker %d démarré", index, extra=fields(queue=f"updates:{index}", backend=STATE_BACKEND))
+        try:
+            await wait_warm()
+            mark_ready()
+            await (serving or consumer)
+        finally:
+            bot_state.ready = False
+            if serving:
+                server.should_exit = True
+                await serving
+            consumer.cancel()
+            await application.stop()
+            await close_clients(application)
+
+def worker_process(index):
+    setup_logging()
+    asyncio.run(run_worker(index))
+
+def spawn_workers(count):
+    """ROLE=all avec WORKERS>1 : lance les workers en processus locaux"""
+    import multiprocessing
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    for index in range(count):
+        process = context.Process(target=worker_process, args=(index,), name=f"hero-worker-{index}", daemon=True)
+        process.start()
+        processes.append(process)
+    return processes
+
+def build_application(updater=USE_POLLING, request=None, rate_limiter=None):
+    # Updates traités en parallèle, un utilisateur lent (ou trop pressé) ne bloque plus les autres
+    builder = Application.builder().token(BOT_TOKEN).concurrent_updates(ChatScheduler())
+    # Envois régulés (anti-flood) et éditions intermédiaires fusionnées
+    builder.rate_limiter(rate_limiter or OutboundLimiter(state_backend))
+    if request is not None:
+        # Transport de l'API Bot remplacé (ex. faux Telegram du banc d'essai)
+        builder.request(request).get_updates_request(request)
+    if not updater:
+        builder.updater(None)
+    application = builder.build()
+    
+    application.add_handler(TypeHandler(Update, bind_update), group=-1)
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("bulk", bulk_order))
+    application.add_handler(CallbackQueryHandler(button_handler))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, search_service))
+    return application
+
+async def main():
+    setup_logging()
+    if WORKERS > 1 or ROLE != "all":
+        if not state_backend.shared or USE_POLLING:
+            log.error("Plusieurs workers : STATE_BACKEND=redis et le mode webhook sont requis")
+            return
+    if ROLE == "worker":
+        await run_worker(WORKER_INDEX)
+        return
+
+    # Ingress : ce processus ne fait que répartir les updates entre les workers
+    ingress = ROLE == "ingress" or WORKERS > 1
+    workers = spawn_workers(WORKERS) if ROLE == "all" and WORKERS > 1 else []
+    application = build_application()
+    # Le serveur écoute avant le préchauffage : /healthz répond, /readyz attend
+    server = create_server(create_web_app(application, dispatch=push_update if ingress else None), PORT)
+    serving = asyncio.create_task(server.serve())
+    log.info("HTTP Server started on port %d", PORT)
     
-    elif query.data.startswith("check_"):
-        activation_id = query.data.split("_")[1]
-        status = get_sms_code(activation_id)
+    async with application:
+        if not ingress:
+            await start_services(application)
+            await application.start()
         
-        if "STATUS_OK" in status:
-            code = status.replace("STATUS_OK:", "")
-            await confirm_sms(activation_id)
-            
-            keyboard = [[InlineKeyboardButton("🔙 Menu", callback_data="back_menu")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                f"✅ *Code reçu !*\n\n🔢 `{code}`",
-                reply_markup=reply_markup,
-                parse_mode="Markdown"
-            )
-        elif "STATUS_WAIT_CODE" in status:
-            await query.answer("⏳ Pas encore reçu", show_alert=True)
+        if USE_POLLING:
+            await application.updater.start_polling()
+            log.info("Bot Telegram démarré (long polling)")
         else:
-            keyboard = [
-                [InlineKeyboardButton("🔄 Réessayer", callback_data=f"check_{activation_id}")],
-                [InlineKeyboardButton("❌ Annuler", callback_data=f"cancel_{activation_id}")],
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(
-                f"⚠️ Statut : `{status}`",
-                reply_markup=reply_markup,
-                parse_mode="Markdown"
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
             )
-    
-    elif query.data.startswith("cancel_"):
-        activation_id = query.data.split("_")[1]
-        result = cancel_activation(activation_id)
+            log.info("Bot Telegram démarré (webhook %s)", WEBHOOK_PATH)
         
-        keyboard = [[InlineKeyboardButton("🔙 Menu", callback_data="back_menu")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        if workers:
+            log.info("%d workers lancés", len(workers))
+        try:
+            if not ingress:
+                await wait_warm()
+            mark_ready()
+            await serving
+        finally:
+            server.should_exit = True
+            await serving
+        bot_state.ready = False
         
-        if "ACCESS_CANCEL" in result:
-            await query.edit_message_text(
-                "✅ Annulé, argent remboursé",
-                reply_markup=reply_markup
-            )
+        if USE_POLLING:
+            await application.updater.stop()
+        if ingress:
+            await state_backend.close()
         else:
-            await query.edit_message_text(
-                f"⚠️ `{result}`",
-                reply_markup=reply_markup,
-                parse_mode="Markdown"
-            )
+            await application.stop()
+            await close_clients(application)
+        for process in workers:
+            process.terminate()
 
-# ===== Main =====
+
+bot_state.record("import", time.perf_counter() - IMPORT_STARTED)
 
 if __name__ == "__main__":
-    # Démarrer le serveur HTTP en arrière-plan
-    http_thread = Thread(target=start_http_server, daemon=True)
-    http_thread.start()
-    
-    # Démarrer le bot
-    app = Application.builder().token(BOT_TOKEN).build()
-    
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CallbackQueryHandler(button_handler))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, search_service))
-    
-    print("🤖 Bot Telegram démarré !")
-    app.run_polling()
+    asyncio.run(main())
@@ -0,0 +1,355 @@
+"""Aiguillage des callbacks, hors ligne (faux update et fausse requête callback)"""
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import hero_telegram_bot as bot
+from hero_telegram_bot import BACK_MENU_MARKUP, MAIN_MENU_MARKUP, CallbackRouter, HeroUnavailable
+
+
+class FakeQuery:
+    """Requête callback qui enregistre les appels au lieu de parler à Telegram"""
+
+    def __init__(self, data, user_id=42):
+        self.data = data
+        self.from_user = SimpleNamespace(id=user_id)
+        self.message = SimpleNamespace(chat_id=user_id, message_id=7)
+        self.answers = []
+        self.edits = []
+
+    async def answer(self, text=None, show_alert=False):
+        self.answers.append((text, show_alert))
+
+    async def edit_message_text(self, text, reply_markup=None, parse_mode=None):
+        self.edits.append((text, reply_markup))
+
+
+def fake_update(data, user_id=42):
+    return SimpleNamespace(callback_query=FakeQuery(data, user_id))
+
+
+def dispatch(router, data):
+    update = fake_update(data)
+    asyncio.run(router.dispatch(update, None))
+    return update.callback_query
+
+
+async def click(data, user_data=None, user_id=42):
+    """Un clic passé par le vrai routeur ; renvoie la requête (réponses et éditions)"""
+    update = fake_update(data, user_id)
+    context = SimpleNamespace(user_data={} if user_data is None else user_data)
+    await bot.router.dispatch(update, context)
+    return update.callback_query
+
+
+@pytest.mark.parametrize("data", ["balance", "order", "back_menu", "activations", "history"])
+def test_resolve_exact_routes(data):
+    route, handler, answer, arg = bot.router.resolve(data)
+    assert route == data
+    assert handler is not None
+    assert arg is None
+
+
+@pytest.mark.parametrize("data, route, arg", [
+    ("srv_tg", "srv", "tg"),
+    ("ctry_tg_6", "ctry", "tg_6"),
+    ("check_123456", "check", "123456"),
+    ("cancel_123456", "cancel", "123456"),
+    ("acts_2", "acts", "2"),
+    ("hist_3", "hist", "3"),
+    ("quick_tg_c", "quick", "tg_c"),
+])
+def test_resolve_prefix_routes(data, route, arg):
+    resolved_route, handler, _, resolved_arg = bot.router.resolve(data)
+    assert resolved_route == route
+    assert handler is not None
+    assert resolved_arg == arg
+
+
+def test_check_route_answers_itself():
+    assert bot.router.resolve("check_1")[2] is False
+    assert bot.router.resolve("srv_tg")[2] is True
+
+
+@pytest.mark.parametrize("data", ["", "nope", "srv", "unknown_prefix_1"])
+def test_resolve_unknown_data(data):
+    assert bot.router.resolve(data) == ("unknown", None, True, None)
+
+
+def test_dispatch_answers_once_before_handler():
+    router = CallbackRouter()
+    seen = []
+
+    @router.prefix("srv")
+    async def handler(query, context, arg):
+        seen.append((arg, list(query.answers)))
+
+    query = dispatch(router, "srv_tg")
+    assert seen == [("tg", [(None, False)])]
+    assert query.answers == [(None, False)]
+
+
+def test_dispatch_without_answer_leaves_it_to_route():
+    router = CallbackRouter()
+
+    @router.prefix("check", answer=False)
+    async def handler(query, context, arg):
+        await query.answer("⏳ Pas encore reçu", show_alert=True)
+
+    query = dispatch(router, "check_42")
+    assert query.answers == [("⏳ Pas encore reçu", True)]
+
+
+def test_dispatch_unknown_data_is_only_answered():
+    query = dispatch(CallbackRouter(), "whatever")
+    assert query.answers == [(None, False)]
+    assert query.edits == []
+
+
+def test_dispatch_busy_reply_when_answered():
+    router = CallbackRouter()
+
+    @router.route("balance")
+    async def handler(query, context, arg):
+        raise HeroUnavailable("circuit ouvert")
+
+    query = dispatch(router, "balance")
+    assert query.answers == [(None, False)]
+    assert query.edits == [(bot.BUSY_TEXT, BACK_MENU_MARKUP)]
+
+
+def test_dispatch_busy_alert_when_not_answered():
+    router = CallbackRouter()
+
+    @router.prefix("check", answer=False)
+    async def handler(query, context, arg):
+        raise HeroUnavailable("circuit ouvert")
+
+    query = dispatch(router, "check_42")
+    assert query.answers == [(bot.BUSY_TEXT, True)]
+    assert query.edits == []
+
+
+def test_dispatch_other_errors_propagate():
+    router = CallbackRouter()
+
+    @router.route("boom")
+    async def handler(query, context, arg):
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        dispatch(router, "boom")
+
+
+def test_menu_markup_is_reused():
+    first = dispatch(bot.router, "back_menu")
+    second = dispatch(bot.router, "back_menu")
+    assert first.edits[0][1] is MAIN_MENU_MARKUP
+    assert second.edits[0][1] is MAIN_MENU_MARKUP
+
+
+def test_back_markup_is_reused():
+    router = CallbackRouter()
+
+    @router.route("balance")
+    async def handler(query, context, arg):
+        raise HeroUnavailable("circuit ouvert")
+
+    first = dispatch(router, "balance")
+    second = dispatch(router, "balance")
+    assert first.edits[0][1] is second.edits[0][1] is BACK_MENU_MARKUP
+
+
+# ===== Routes réelles, HeroSMS et Telegram simulés =====
+
+TOP_TG = [
+    {"country": 6, "count": 500, "price": 0.25},
+    {"country": 0, "count": 80, "price": 0.4},
+]
+
+
+class FakeHero:
+    """Réponses HeroSMS scriptées pour le compte unique du pool de test"""
+
+    def __init__(self, client):
+        self.calls = []
+        self.status = "STATUS_WAIT_CODE"
+        self.cancel = "ACCESS_CANCEL"
+        self.number = "ACCESS_NUMBER:555:+6281234"
+        for name in ("get_countries_for_service", "request_number", "get_sms_code", "confirm_sms",
+                     "cancel_activation"):
+            setattr(client, name, getattr(self, name))
+
+    async def get_countries_for_service(self, service):
+        self.calls.append(("getTopCountriesByService", service))
+        return list(TOP_TG)
+
+    async def request_number(self, service, country):
+        self.calls.append(("getNumber", service, country))
+        return self.number
+
+    async def get_sms_code(self, activation_id):
+        self.calls.append(("getStatus", activation_id))
+        return self.status
+
+    async def confirm_sms(self, activation_id):
+        self.calls.append(("setStatus6", activation_id))
+        return "ACCESS_ACTIVATION"
+
+    async def cancel_activation(self, activation_id):
+        self.calls.append(("setStatus8", activation_id))
+        return self.cancel
+
+
+@pytest.fixture
+def env(monkeypatch, tmp_path):
+    """Pool, caches, base et surveillance neufs, branchés sur un faux HeroSMS"""
+    pool = bot.KeyPool(["test-key"])
+    pool.primary._set_balance(10.0)
+    store = bot.ActivationStore(str(tmp_path / "store.sqlite3"), flush_interval=60)
+    monkeypatch.setattr(bot, "key_pool", pool)
+    monkeypatch.setattr(bot, "hero", pool.primary.client)
+    monkeypatch.setattr(bot, "activation_store", store)
+    monkeypatch.setattr(bot, "activation_watcher", bot.ActivationWatcher(pool, store, bot.MemoryBackend()))
+    monkeypatch.setattr(bot, "top_countries", bot.KeyedCache("top_countries", bot.load_top_countries, 60))
+    monkeypatch.setattr(bot.price_index, "quick_pick", lambda service, mode: None)
+    bot.country_directory.resource.set([bot.CountryRecord(6, "Indonesia"), bot.CountryRecord(0, "Russia")])
+    return SimpleNamespace(pool=pool, store=store, hero=FakeHero(pool.primary.client))
+
+
+def run(env, scenario):
+    async def main():
+        await env.store.open()
+        try:
+            await scenario()
+        finally:
+            await env.store.close()
+    asyncio.run(main())
+
+
+def buttons(markup):
+    return [button.callback_data for row in markup.inline_keyboard for button in row]
+
+
+def test_srv_cold_then_cached(env):
+    async def scenario():
+        cold = await click("srv_tg")
+        assert cold.answers == [(None, False)]
+        assert cold.edits[0] == ("⏳ Recherche des pays...", None)
+        text, markup = cold.edits[-1]
+        assert text.startswith("🌍 *Pays pour tg*")
+        assert buttons(markup)[:2] == ["ctry_6", "ctry_0"]
+
+        cached = await click("srv_tg")
+        assert len(cached.edits) == 1
+        assert buttons(cached.edits[0][1]) == buttons(markup)
+        assert env.hero.calls == [("getTopCountriesByService", "tg")]
+    run(env, scenario)
+
+
+def test_ctry_without_user_data_uses_stored_service(env):
+    async def scenario():
+        await click("srv_tg")
+        # Redémarrage : user_data perdu, le service est relu depuis la base
+        query = await click("ctry_6", user_data={})
+        assert ("getNumber", "tg", "6") in env.hero.calls
+        assert query.edits[-1][0].startswith("✅ *Numéro reçu !*")
+        assert buttons(query.edits[-1][1]) == ["check_555", "cancel_555"]
+        assert bot.activation_watcher.is_waiting("555")
+        row = await env.store.get_activation("555")
+        assert (row["user_id"], row["service"], row["account"]) == (42, "tg", env.pool.primary.label)
+        assert env.pool.primary.balance == pytest.approx(9.75)
+    run(env, scenario)
+
+
+def test_ctry_without_any_service(env):
+    async def scenario():
+        query = await click("ctry_6", user_data={})
+        assert query.edits == [("❌ Erreur. /start pour recommencer", None)]
+        assert not any(call[0] == "getNumber" for call in env.hero.calls)
+    run(env, scenario)
+
+
+def test_quick_orders_picked_country(env, monkeypatch):
+    monkeypatch.setattr(bot.price_index, "quick_pick", lambda service, mode: bot.CountryOffer(6, 0.25, 500))
+
+    async def scenario():
+        query = await click("quick_tg_c")
+        assert ("getNumber", "tg", 6) in env.hero.calls
+        assert query.edits[-1][0].startswith("✅ *Numéro reçu !*")
+    run(env, scenario)
+
+
+def test_quick_without_offer_falls_back_to_countries(env):
+    async def scenario():
+        query = await click("quick_tg_c")
+        assert query.edits[-1][0].startswith("🌍 *Pays pour tg*")
+        assert not any(call[0] == "getNumber" for call in env.hero.calls)
+    run(env, scenario)
+
+
+def test_check_while_watched_does_not_call_hero(env):
+    async def scenario():
+        bot.activation_watcher.watch("555", chat_id=42, message_id=7)
+        query = await click("check_555")
+        assert query.answers == [("⏳ Pas encore reçu, le code s'affichera automatiquement", True)]
+        assert env.hero.calls == []
+    run(env, scenario)
+
+
+def test_check_wait(env):
+    async def scenario():
+        query = await click("check_555")
+        assert query.answers == [("⏳ Pas encore reçu", True)]
+        assert query.edits == []
+    run(env, scenario)
+
+
+def test_check_ok_shows_code_and_releases(env):
+    async def scenario():
+        env.hero.status = "STATUS_OK:123456"
+        env.pool.bind("555", env.pool.primary)
+        env.pool.primary.holds["555"] = 0.25
+        query = await click("check_555")
+        assert query.answers == [(None, False)]
+        assert "123456" in query.edits[-1][0]
+        assert query.edits[-1][1] is BACK_MENU_MARKUP
+        assert env.hero.calls[-1] == ("setStatus6", "555")
+        assert "555" not in env.pool.owners and env.pool.primary.holds == {}
+    run(env, scenario)
+
+
+def test_check_refuses_other_users_activation(env):
+    async def scenario():
+        env.store.record_activation("555", 1, 1, 7, "tg", 6, "+62", 0, env.pool.primary.label)
+        query = await click("check_555", user_id=42)
+        assert query.answers == [(bot.NOT_OWNER_TEXT, True)]
+        assert env.hero.calls == []
+    run(env, scenario)
+
+
+def test_cancel_refunds(env):
+    async def scenario():
+        await click("srv_tg")
+        await click("ctry_6", user_data={"service": "tg"})
+        assert env.pool.primary.balance == pytest.approx(9.75)
+
+        query = await click("cancel_555")
+        assert query.edits[-1] == ("✅ Annulé, argent remboursé", BACK_MENU_MARKUP)
+        assert env.pool.primary.balance == pytest.approx(10.0)
+        assert not bot.activation_watcher.is_waiting("555")
+        assert (await env.store.get_activation("555"))["status"] == "cancelled"
+    run(env, scenario)
+
+
+def test_cancel_refused_by_hero_keeps_hold(env):
+    async def scenario():
+        env.hero.cancel = "EARLY_CANCEL_DENIED"
+        env.pool.bind("555", env.pool.primary)
+        env.pool.primary.debit("555", 0.25)
+        query = await click("cancel_555")
+        assert "EARLY_CANCEL_DENIED" in query.edits[-1][0]
+        assert env.pool.primary.balance == pytest.approx(9.75)
+    run(env, scenario)